@@ -1,67 +1,121 @@
-from fastapi import APIRouter, HTTPException, File, UploadFile
-from app.schemas.report_schema import ReportRequest, MedicalReport
-from app.services.medical_report_service import MedicalReportService
+from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, Response
+from fastapi.responses import StreamingResponse
+from app.schemas.report_schema import ReportRequest
+from app.schemas.report_struct import FileAnalysis, MedicalReport, report_encoder
+from app.services.medical_report_service import MedicalReportService, ServiceBusyError, get_medical_report_service
+from app.utils.hashing import content_hash
+from datetime import datetime, timezone
 from pathlib import Path
+from typing import Tuple
+import asyncio
+import os
 import tempfile
 
+# Uploads are streamed to disk in chunks of this size instead of read whole.
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+_VALID_EXTS = frozenset({'.pdf', '.jpg', '.jpeg', '.png', '.gif', '.webp'})
+_PDF_EXTS = frozenset({'.pdf'})
+_INVALID_TYPE_DETAIL = f"Invalid file type. Supported: {', '.join(sorted(_VALID_EXTS))}"
+
 router = APIRouter()
 
-@router.post("/generate-report")
-async def generate_report(request: ReportRequest):
+def _save_upload(src, temp_dir: str, suffix: str) -> Tuple[Path, str]:
+    """Copy an upload's spooled file to a uniquely named temp file in chunks.
+
+    Returns the temp file path and the content hash hex digest.
+    """
+    digest = content_hash()
+    with tempfile.NamedTemporaryFile(dir=temp_dir, suffix=suffix, delete=False) as tmp:
+        for chunk in iter(lambda: src.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+            tmp.write(chunk)
+    return Path(tmp.name), digest.hexdigest()
+
+@router.post("/generate-report", response_model=None)
+async def generate_report(
+    request: ReportRequest,
+    service: MedicalReportService = Depends(get_medical_report_service),
+):
     try:
-        service = MedicalReportService()
         report = await service.generate_report(request.user_id)
-        return report
+        # The report comes from our own service pipeline, so it is trusted:
+        # the msgspec Struct is built without validation and encoded directly.
+        body = report_encoder.encode(MedicalReport(**report))
+        return Response(content=body, media_type="application/json")
+    except ServiceBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-# have to make or do this async to avoid blocking
+@router.post("/generate-report/stream", response_model=None)
+async def generate_report_stream(
+    request: ReportRequest,
+    service: MedicalReportService = Depends(get_medical_report_service),
+):
+    """Stream report generation progress and the model output as NDJSON events."""
+    return StreamingResponse(
+        service.generate_report_stream(request.user_id),
+        media_type="application/x-ndjson",
+    )
 
-# @router.post("/analyze-file-for-test")
-# def analyze_file(file: UploadFile = File(...)):
-#     """
-#     Upload a PDF or image file and get a medical report analysis.
+@router.post("/analyze-file-for-test", response_model=None)
+async def analyze_file(
+    file: UploadFile = File(...),
+    service: MedicalReportService = Depends(get_medical_report_service),
+):
+    """
+    Upload a PDF or image file and get a medical report analysis.
     
-#     Supported formats:
-#     - PDF (.pdf)
-#     - Images (.jpg, .jpeg, .png, .gif, .webp)
-#     """
-#     try:
-#         # Validate file type
-#         file_extension = Path(file.filename).suffix.lower()
-#         valid_extensions = {'.pdf', '.jpg', '.jpeg', '.png', '.gif', '.webp'}
-        
-#         if file_extension not in valid_extensions:
-#             raise HTTPException(
-#                 status_code=400, 
-#                 detail=f"Invalid file type. Supported: {', '.join(valid_extensions)}"
-#             )
+    Supported formats:
+    - PDF (.pdf)
+    - Images (.jpg, .jpeg, .png, .gif, .webp)
+    """
+    try:
+        # Validate file type
+        name = file.filename or ''
+        dot = name.rfind('.')
+        file_extension = name[dot:].lower() if dot >= 0 else ''
         
-#         # Determine file type
-#         if file_extension == '.pdf':
-#             file_type = 'pdf'
-#         else:
-#             file_type = 'image'
+        if file_extension not in _VALID_EXTS:
+            raise HTTPException(status_code=400, detail=_INVALID_TYPE_DETAIL)
         
-#         # Save uploaded file to temp directory
-#         service = MedicalReportService()
-#         temp_file_path = service.temp_dir / file.filename
+        # Determine file type
+        file_type = 'pdf' if file_extension in _PDF_EXTS else 'image'
         
-#         with open(temp_file_path, "wb") as f:
-#             f.write(file.file.read())
+        # Stream uploaded file to temp directory without buffering it in memory,
+        # hashing it in the same pass for the analysis cache key. The client
+        # filename is never used as a path.
+        temp_file_path, file_hash = await asyncio.to_thread(
+            _save_upload, file.file, service.temp_dir_str, file_extension
+        )
         
-#         # Analyze the file
-#         analysis = service.analyze_file_only(temp_file_path, file_type)
+        # Analyze the file, reusing a cached analysis of identical content
+        try:
+            cache_key = (file_hash, file_type)
+            analysis = service.file_analysis_cache.get(cache_key)
+            if analysis is None:
+                if service.file_batch_queue is None:
+                    analysis = await service.analyze_file_only(temp_file_path, file_type)
+                else:
+                    # concurrent uploads are coalesced into batched OpenAI calls
+                    future = await service.file_batch_queue.add_request(temp_file_path, file_type)
+                    analysis = await future
+                service.file_analysis_cache.set(cache_key, analysis)
+        finally:
+            temp_file_path.unlink(missing_ok=True)
         
-#         response = {
-#             "filename": file.filename,
-#             "file_type": file_type,
-#             "medical_analysis": analysis,
-#             "generation_timestamp": __import__('datetime').datetime.now().isoformat()
-#         }
+        response = FileAnalysis(
+            filename=os.path.basename(name),
+            file_type=file_type,
+            medical_analysis=analysis,
+            generation_timestamp=datetime.now(timezone.utc).isoformat()
+        )
         
-#         return response
-#     except HTTPException:
-#         raise
-#     except Exception as e:
-#         raise HTTPException(status_code=500, detail=str(e))
+        return Response(content=report_encoder.encode(response), media_type="application/json")
+    except HTTPException:
+        raise
+    except ServiceBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
@@ -1,4 +1,6 @@
 import os
+from dataclasses import dataclass, field
+from functools import lru_cache
 
 # Try to load environment variables from a .env file if python-dotenv is available.
 try:
@@ -9,10 +11,26 @@ except Exception:
 
 load_dotenv()
 
+@dataclass(slots=True, frozen=True)
 class Settings:
-    def __init__(self):
-        self.OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
-        self.BASE_URL = os.getenv("BASE_URL", "")
+    OPENAI_API_KEY: str = field(default_factory=lambda: os.getenv("OPENAI_API_KEY", ""), repr=False)
+    BASE_URL: str = field(default_factory=lambda: os.getenv("BASE_URL", ""))
+    OPENAI_CONCURRENCY: int = field(default_factory=lambda: int(os.getenv("OPENAI_CONCURRENCY", "32")))
+    OPENAI_MAX_WAITING: int = field(default_factory=lambda: int(os.getenv("OPENAI_MAX_WAITING", "64")))
+    DOWNLOAD_CONCURRENCY: int = field(default_factory=lambda: int(os.getenv("DOWNLOAD_CONCURRENCY", "32")))
+    EXTRACTION_MODEL: str = field(default_factory=lambda: os.getenv("EXTRACTION_MODEL", "gpt-4o-mini"))
+    REPORT_MODEL: str = field(default_factory=lambda: os.getenv("REPORT_MODEL", "gpt-4o"))
+    # Uploads from different users analyzed in one OpenAI request pair (1 = off)
+    FILE_BATCH_SIZE: int = field(default_factory=lambda: int(os.getenv("FILE_BATCH_SIZE", "1")))
+    CORS_ORIGINS: str = field(default_factory=lambda: os.getenv(
+        "CORS_ORIGINS",
+        "http://localhost:5173,https://dockmnk.netlify.app,http://localhost:5174",
+    ))
 
 
-settings = Settings()
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    return Settings()
+
+
+settings = get_settings()
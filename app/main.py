@@ -1,22 +1,55 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
+from starlette.middleware.gzip import DEFAULT_EXCLUDED_CONTENT_TYPES
 from app.api.v1.endpoints import medical_report
+from app.config import settings
+from app.schemas.report_struct import FileAnalysis, MedicalReport, report_encoder
+from app.services.medical_report_service import get_medical_report_service
+
+# Explicit origin allow-list (comma separated in CORS_ORIGINS)
+ALLOWED_ORIGINS = frozenset(o.strip() for o in settings.CORS_ORIGINS.split(",") if o.strip())
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # msgspec builds per-type encoders on first use: warm them before the first request.
+    report_encoder.encode(MedicalReport(patient_id="", medical_analysis={}, generation_timestamp=""))
+    report_encoder.encode(FileAnalysis(filename="", file_type="", medical_analysis={}, generation_timestamp=""))
+    app.state.report_encoder = report_encoder
+    yield
+    # close the shared HTTP session, but only if a request ever built the service
+    if get_medical_report_service.cache_info().currsize:
+        await get_medical_report_service().close()
 
 app = FastAPI(
     title="Medical Report Generator API",
     version="1.0.0",
-    description="Generates structured medical reports using OpenAI and Cloudinary data."
+    description="Generates structured medical reports using OpenAI and Cloudinary data.",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
 )
 
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=[ "http://localhost:5173", "https://dockmnk.netlify.app", "http://localhost:5174"],
+    allow_origins=sorted(ALLOWED_ORIGINS),
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
+# Report JSON is large and highly compressible; NDJSON progress streams are
+# excluded because gzip would buffer every event until the stream ends
+app.add_middleware(
+    GZipMiddleware,
+    minimum_size=1024,
+    compresslevel=5,
+    exclude_content_types=(*DEFAULT_EXCLUDED_CONTENT_TYPES, "application/x-ndjson"),
+)
+
 
 app.include_router(medical_report.router, prefix="/api/v1", tags=["Medical Report"])
 
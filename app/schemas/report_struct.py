@@ -0,0 +1,28 @@
+import msgspec
+from typing import Any, Dict, List, Optional
+
+class FileInfo(msgspec.Struct):
+    url: str
+    field: str
+    type: str
+
+class MedicalReport(msgspec.Struct, kw_only=True, omit_defaults=True):
+    """msgspec response envelope for /generate-report.
+
+    medical_analysis stays a plain dict: the LLM output carries sections beyond the
+    fixed MedicalAnalysis fields, and a Struct would drop them.
+    """
+    patient_id: str
+    medical_analysis: Dict[str, Any]
+    generation_timestamp: str
+    patient_data: Optional[Dict[str, Any]] = None
+    files_analyzed: Optional[List[FileInfo]] = None
+
+class FileAnalysis(msgspec.Struct, kw_only=True):
+    """msgspec response envelope for /analyze-file-for-test."""
+    filename: str
+    file_type: str
+    medical_analysis: Dict[str, Any]
+    generation_timestamp: str
+
+report_encoder = msgspec.json.Encoder()
@@ -0,0 +1,111 @@
+import asyncio
+from typing import Any, Awaitable, Callable, List, Optional, Set, Tuple
+
+
+class AsyncBatchQueue:
+    """Coalesce concurrent requests into batches for a single batched call.
+
+    Callers `await queue.add_request(...)` and get back a future for their own
+    result. A background loop collects up to `max_batch_size` requests, waiting
+    at most `max_wait_time` seconds after the first one arrives, and hands the
+    argument tuples to `process_fn`, which must return one result per request
+    in the same order; a result that is an exception is raised to that caller
+    only. Each batch runs as its own task, so the loop goes straight back to
+    collecting the next one; at most `max_concurrent_batches` run at a time.
+    """
+
+    def __init__(
+        self,
+        process_fn: Callable[[List[Tuple[Any, ...]]], Awaitable[List[Any]]],
+        max_batch_size: int = 8,
+        max_wait_time: float = 0.1,
+        max_concurrent_batches: int = 4,
+    ):
+        self.process_fn = process_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_time = max_wait_time
+        self.max_concurrent_batches = max_concurrent_batches
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._batch_tasks: Set[asyncio.Task] = set()
+
+    def start(self) -> None:
+        """Start the processing loop on the running event loop (idempotent)."""
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self.max_concurrent_batches)
+            self._task = asyncio.create_task(self.process_loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for task in list(self._batch_tasks):
+            task.cancel()
+        if self._batch_tasks:
+            await asyncio.gather(*self._batch_tasks, return_exceptions=True)
+
+    async def add_request(self, *args: Any) -> asyncio.Future:
+        """Enqueue one request and return the future that will hold its result."""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((args, future))
+        return future
+
+    async def _collect_batch(self) -> List[Tuple[Tuple[Any, ...], asyncio.Future]]:
+        batch = [await self._queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_wait_time
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def process_loop(self) -> None:
+        while True:
+            batch = await self._collect_batch()
+            # requests whose caller has gone away are dropped from the batch
+            batch = [(args, fut) for args, fut in batch if not fut.done()]
+            if not batch:
+                continue
+
+            # wait for a free slot, then keep collecting while this batch runs
+            await self._slots.acquire()
+            task = asyncio.create_task(self._run_batch(batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _run_batch(self, batch: List[Tuple[Tuple[Any, ...], asyncio.Future]]) -> None:
+        try:
+            try:
+                results = await self.process_fn([args for args, _ in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(
+                        f"Batch returned {len(results)} results for {len(batch)} requests"
+                    )
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                return
+
+            for (_, fut), result in zip(batch, results):
+                if fut.done():
+                    continue
+                if isinstance(result, BaseException):
+                    fut.set_exception(result)
+                else:
+                    fut.set_result(result)
+        finally:
+            self._slots.release()
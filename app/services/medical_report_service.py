@@ -1,26 +1,45 @@
 import os
-import json
 import base64
 import mimetypes
 from pathlib import Path
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, AsyncIterator, Awaitable, Callable, List, Optional, Tuple
 from datetime import datetime
 import asyncio
 import io
+import mmap
+import multiprocessing
+import re
+import shutil
+import tempfile
+import threading
+from collections import deque
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 
 import aiohttp
+import anyio
+import openai
+import orjson
 from openai import AsyncOpenAI
+from tenacity import (
+    retry,
+    retry_if_exception,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
 from reportlab.lib.pagesizes import A4
 from reportlab.lib import colors
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.lib.units import mm
+from reportlab.pdfbase.pdfmetrics import stringWidth
 from app.config import settings
-
-try:
-    import PyPDF2
-except ImportError:
-    PyPDF2 = None
+from app.services.batch_queue import AsyncBatchQueue
+from app.utils.cache import ResponseCache
+from app.utils.hashing import content_hash, file_digest
+from app.utils.pdf_text import PDF_TEXT_AVAILABLE, extract_pdf_page_range, pdf_page_count
 
 try:
     from PIL import Image
@@ -32,124 +51,195 @@ try:
 except Exception:
     pytesseract = None
 
+try:
+    import tesserocr
+except Exception:
+    tesserocr = None
 
-class MedicalReportService:
-    def __init__(self):
-        self.openai_client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
-        self.base_url = settings.BASE_URL
-        self.temp_dir = Path("temp_medical_files")
-        self.temp_dir.mkdir(exist_ok=True)
-
-    async def fetch_patient_data(self, user_id: str) -> Dict[str, Any]:
-        url = f"{self.base_url}/patient-registration/{user_id}"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=30)) as response:
-                response.raise_for_status()
-                return await response.json()
-
-    def extract_cloudinary_urls(self, data: Dict[str, Any]) -> List[Dict[str, str]]:
-        """Recursively extract all cloudinary URLs from the patient data structure."""
-        urls = []
-        
-        def search(obj, path=""):
-            if isinstance(obj, dict):
-                for k, v in obj.items():
-                    new_path = f"{path}.{k}" if path else k
-                    search(v, new_path)
-            elif isinstance(obj, list):
-                for i, item in enumerate(obj):
-                    search(item, f"{path}[{i}]")
-            elif isinstance(obj, str) and "cloudinary.com" in obj:
-                urls.append({
-                    "url": obj,
-                    "field": path,
-                    "type": self._guess_type(obj)
-                })
-        
-        search(data)
-        return urls
-
-    def _guess_type(self, url: str) -> str:
-        url = url.lower()
-        if any(x in url for x in [".pdf", "/pdf/"]):
-            return "pdf"
-        elif any(x in url for x in [".jpg", ".jpeg", ".png", ".gif", ".webp", "/image/"]):
-            return "image"
-        return "unknown"
-
-    async def download_file(self, url: str, filename: str) -> Optional[Path]:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=60)) as response:
-                response.raise_for_status()
-                file_path = self.temp_dir / filename
-                content = await response.read()
-                await asyncio.to_thread(file_path.write_bytes, content)
-                return file_path
-
-    async def encode_image_to_base64(self, image_path: Path) -> str:
-        def _encode():
-            with open(image_path, "rb") as f:
-                return base64.b64encode(f.read()).decode("utf-8")
-        
-        return await asyncio.to_thread(_encode)
-
-    async def extract_text_from_pdf(self, pdf_path: Path) -> str:
-        """Extract text from PDF using PyPDF2."""
-        if PyPDF2 is None:
-            return ""
-        
-        def _extract():
-            try:
-                text = ""
-                with open(pdf_path, "rb") as f:
-                    reader = PyPDF2.PdfReader(f)
-                    for page in reader.pages:
-                        text += page.extract_text() + "\n"
-                return text
-            except Exception as e:
-                print(f"Error extracting PDF text: {e}")
-                return ""
-        
-        return await asyncio.to_thread(_extract)
-
-    async def extract_text_from_files(self, files: List[Dict[str, Any]]) -> str:
-        """Extract text from all downloaded files (images + PDFs) using OCR."""
-        extracted_texts: List[str] = []
-        
-        for f in files:
-            try:
-                if f.get('type') == 'pdf' and f.get('path'):
-                    text = await self.extract_text_from_pdf(f['path'])
-                    if text and text.strip():
-                        extracted_texts.append(f"--- Text from {f['field']} (PDF) ---\n{text}")
-                elif f.get('type') == 'image' and f.get('path'):
-                    ocr_text = ""
-                    if Image is not None and pytesseract is not None:
-                        try:
-                            ocr_text = await asyncio.to_thread(self._ocr_image, f['path'])
-                        except Exception as e:
-                            print(f"Image OCR failed for {f['path']}: {e}")
-
-                    if ocr_text and ocr_text.strip():
-                        extracted_texts.append(f"--- OCR text from {f['field']} (IMAGE) ---\n{ocr_text}")
-                    else:
-                        extracted_texts.append(f"--- Image file included: {f['field']} (OCR not available) ---")
+try:
+    import easyocr
+    import numpy as np
+    import torch
+except Exception:
+    easyocr = None
+
+# GPU OCR is only used when EasyOCR is installed and a CUDA device is present
+EASYOCR_GPU = easyocr is not None and torch.cuda.is_available()
+
+# Whether images can be OCR'd locally; otherwise they are only sent to the model by URL
+OCR_AVAILABLE = EASYOCR_GPU or (Image is not None and (tesserocr is not None or pytesseract is not None))
+
+# Process-wide caps on in-flight OpenAI requests and file downloads
+OPENAI_LIMITER = anyio.CapacityLimiter(settings.OPENAI_CONCURRENCY)
+DOWNLOAD_LIMITER = anyio.CapacityLimiter(settings.DOWNLOAD_CONCURRENCY)
+
+DOWNLOAD_CHUNK_SIZE = 1 << 16
+
+# Rate limits, dropped connections and 5xx responses are retried with jittered
+# exponential backoff instead of failing the whole report
+_TRANSIENT_OPENAI_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+_retry_openai = retry(
+    retry=retry_if_exception_type(_TRANSIENT_OPENAI_ERRORS),
+    wait=wait_exponential_jitter(multiplier=0.5, max=10),
+    stop=stop_after_attempt(5),
+    reraise=True,
+)
+
+
+# image URLs quoted in OpenAI's "Error while downloading <url>." messages
+_IMAGE_URL_RE = re.compile(r"https?://[^\s'\"]+[^\s'\".,)]")
+
+
+def _without_image_urls(messages: List[Dict[str, Any]], urls: List[str]) -> Optional[List[Dict[str, Any]]]:
+    """Copy of messages without the given remote image blocks (all remote images if none
+    are named); None if there was nothing to remove."""
+    bad = set(urls)
+    removed = False
+    result = []
+    for message in messages:
+        content = message.get("content")
+        if type(content) is list:
+            kept = []
+            for block in content:
+                url = block.get("image_url", {}).get("url", "") if block.get("type") == "image_url" else ""
+                if url.startswith("http") and (url in bad or not bad):
+                    removed = True
                 else:
-                    if f.get('path'):
-                        extracted_texts.append(f"--- File included: {f['field']} (type: {f.get('type')}) ---")
-            except Exception as e:
-                print(f"Error extracting text from {f.get('field')}: {e}")
-
-        return "\n".join(extracted_texts)
-
-    def _ocr_image(self, image_path: Path) -> str:
-        """Helper method for OCR to be run in thread."""
-        img = Image.open(image_path)
-        return pytesseract.image_to_string(img)
-
-    def get_medical_guidelines_prompt(self) -> str:
-        """Return comprehensive medical guidelines for AI analysis."""
-        return """
+                    kept.append(block)
+            message = {**message, "content": kept}
+        result.append(message)
+    return result if removed else None
+
+
+def _is_transient_download_error(exc: BaseException) -> bool:
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status == 429 or exc.status >= 500
+    return isinstance(exc, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError))
+
+
+_retry_download = retry(
+    retry=retry_if_exception(_is_transient_download_error),
+    wait=wait_exponential_jitter(multiplier=0.5, max=10),
+    stop=stop_after_attempt(4),
+    reraise=True,
+)
+
+# network chunks are coalesced into writes of up to this size
+DOWNLOAD_WRITE_SIZE = 1 << 20
+
+_CLOUDINARY_HOST = "cloudinary.com"
+_CLOUDINARY_HOST_LEN = len(_CLOUDINARY_HOST)
+_EXT_TYPES = {"pdf": "pdf", "jpg": "image", "jpeg": "image", "png": "image", "gif": "image", "webp": "image"}
+# file extension at the end of the URL path, then Cloudinary's resource type segment
+_TYPE_RE = re.compile(r"\.(pdf|jpe?g|png|gif|webp)(?=$|[?#])", re.IGNORECASE)
+_KIND_RE = re.compile(r"/(pdf|image)/", re.IGNORECASE)
+
+# PDFs with more pages than this are split across worker processes. PDFium
+# extracts roughly a page per millisecond, so shorter documents finish in a
+# thread before the per-worker dispatch and document re-open pay off.
+PDF_PARALLEL_MIN_PAGES = 32
+
+
+# Tesseract works best around 300 DPI; larger phone photos only cost time
+OCR_MAX_EDGE = 1800
+
+# LSTM engine only, and treat each image as a single block of text (lab report pages)
+TESSERACT_CONFIG = "--oem 1 --psm 6"
+
+# Output token budgets of the file analysis calls. A batched report call gets
+# the per-file budget for every file, so a batch holds at most as many files
+# as fit the model's output limit
+FILE_EXTRACTION_MAX_TOKENS = 1500
+FILE_REPORT_MAX_TOKENS = 4096
+MAX_OUTPUT_TOKENS = 16384
+FILE_BATCH_MAX = MAX_OUTPUT_TOKENS // FILE_REPORT_MAX_TOKENS
+
+# PDF report styles, built once: a stylesheet is ~50 ParagraphStyles and every
+# section table shares one style
+_PDF_STYLES = getSampleStyleSheet()
+_PDF_BODY = _PDF_STYLES['BodyText']
+# Strings up to this width (plain Table cells use Helvetica 10 with 6pt side
+# padding) fit the narrower key column unwrapped
+PDF_PLAIN_CELL_WIDTH = 60*mm - 2*6
+_PDF_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.lightgrey),
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
+    ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+])
+
+# Part of every extracted-text cache key: bump when PDF/OCR extraction changes
+# (engine, preprocessing, page handling, storage format) so stale text is not reused
+TEXT_CACHE_VERSION = 4
+
+
+def _otsu_threshold(histogram: List[int]) -> int:
+    """Return the grey level that best separates a 256-bin histogram into two classes."""
+    total = sum(histogram)
+    sum_all = sum(i * h for i, h in enumerate(histogram))
+    sum_bg = 0.0
+    weight_bg = 0
+    best_threshold, best_variance = 0, -1.0
+    for i, h in enumerate(histogram):
+        weight_bg += h
+        if weight_bg == 0:
+            continue
+        weight_fg = total - weight_bg
+        if weight_fg == 0:
+            break
+        sum_bg += i * h
+        mean_bg = sum_bg / weight_bg
+        mean_fg = (sum_all - sum_bg) / weight_fg
+        variance = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+        if variance > best_variance:
+            best_threshold, best_variance = i, variance
+    return best_threshold
+
+
+def _prepare_for_ocr(img):
+    """Greyscale, downscale to OCR_MAX_EDGE and Otsu-binarize an image for tesseract."""
+    # JPEGs are decoded straight to greyscale at a reduced scale, skipping most pixel work
+    img.draft("L", (OCR_MAX_EDGE, OCR_MAX_EDGE))
+    if 'A' in img.getbands() or 'transparency' in img.info:
+        # flatten onto white like pytesseract does: convert("L") would turn
+        # transparent pixels black and hide text drawn on a transparent background
+        rgba = img.convert("RGBA")
+        img = Image.new("RGB", rgba.size, "white")
+        img.paste(rgba, mask=rgba.getchannel("A"))
+    img = img.convert("L")
+    img.thumbnail((OCR_MAX_EDGE, OCR_MAX_EDGE), Image.LANCZOS)
+    threshold = _otsu_threshold(img.histogram())
+    return img.point([255 if i > threshold else 0 for i in range(256)])
+
+
+def _field_path(path: Tuple[Any, ...]) -> str:
+    """Format a key/index path from the patient data as e.g. "reports[0].file"."""
+    parts: List[str] = []
+    for segment in path:
+        if type(segment) is int:
+            parts.append(f"[{segment}]")
+        else:
+            parts.append(f".{segment}" if parts else str(segment))
+    return "".join(parts)
+
+
+def _write_all(fd: int, data: bytes) -> None:
+    """os.write until all of data is written (a single call may write less)."""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+@lru_cache(maxsize=1024)
+def _read_cached_text(path: Path) -> str:
+    """Read a text cache entry, memoized in process (misses raise and are not memoized).
+
+    Entries are stored as raw bytes: read_text would normalize pypdfium2's CRLF
+    line endings, so a cached run would build a different prompt than the first.
+    """
+    return path.read_bytes().decode("utf-8")
+
+
+_GUIDELINES_PROMPT = """
 # COMPREHENSIVE MEDICAL ANALYSIS GUIDELINES
 
 ## MANDATORY CALCULATIONS (Perform where data exists):
@@ -192,247 +282,161 @@ Macros: Protein 1.2-2.0 g/kg, Fat 20-35%, Carbs 45-65%
 Fluid: Men 2.5-3.7 L/day, Women 2.0-2.7 L/day
 """
 
-    async def analyze_with_openai(self, patient_data: Dict[str, Any], files: List[Dict[str, Any]]) -> Dict[str, Any]:
-        """Dynamic analysis with mandatory core sections + flexible lab sections."""
-        
-        # Extract text from all files with OCR
-        extracted_text = await self.extract_text_from_files(files)
-        
-        # Stage 1: Comprehensive extraction with lab content identification
-        extraction_messages = [
-            {
-                "role": "system", 
-                "content": f"""You are an expert medical data extraction assistant with OCR analysis capabilities.
-
-{self.get_medical_guidelines_prompt()}
-
-EXTRACTION PROTOCOL:
-1. Extract ALL patient demographics, biometrics, vitals
-2. Identify ALL laboratory test categories present (e.g., CBC, LFT, RFT, Lipid Profile, Thyroid, HbA1c, Electrolytes, Hormones, Tumor Markers, etc.)
-3. Extract ALL lab values with units and reference ranges
-4. Extract ALL physical examination findings
-5. Extract ALL medical history and comorbidities
-6. Extract ALL substance use history with quantities
-7. Extract ALL lifestyle data (occupation, activity, sleep, diet, steps)
-8. Extract ALL lower limb vascular findings
-9. Extract ALL medications and allergies
-
-IMPORTANT: For lab results, identify the EXACT test categories present in the documents, don't assume standard categories."""
-            },
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text", 
-                        "text": f"""Extract ALL medical information from these sources:
-
-PATIENT REGISTRATION DATA:
-{json.dumps(patient_data, indent=2)}
-
-EXTRACTED TEXT FROM ALL FILES (PDF & OCR):
-{extracted_text}
-
-Provide comprehensive extraction with:
-1. Complete patient demographics
-2. IDENTIFIED LAB TEST CATEGORIES (list exactly what lab sections exist)
-3. All lab values organized by their actual categories
-4. All vital signs and anthropometric data
-5. Complete medical and substance use history
-6. Physical examination findings
-7. Lifestyle assessment data
-8. Current medications and allergies
-
-Return detailed JSON with actual lab categories found."""
-                    }
-                ]
-            }
-        ]
-        
-        # Add all images for visual analysis
-        for f in files:
-            if f['type'] == 'image' and f['path']:
-                base64_img = await self.encode_image_to_base64(f['path'])
-                mime = mimetypes.guess_type(f['path'])[0] or 'image/jpeg'
-                extraction_messages[-1]["content"].append({
-                    "type": "image_url",
-                    "image_url": {"url": f"data:{mime};base64,{base64_img}"}
-                })
-
-        resp1 = await self.openai_client.chat.completions.create(
-            model="gpt-4o",
-            messages=extraction_messages,
-            temperature=0.2,
-            max_tokens=4000
-        )
-        extracted_data = resp1.choices[0].message.content
-        
-        # Stage 2: Generate structured report with dynamic lab sections
-        report_prompt = f"""Generate a COMPREHENSIVE medical report with MANDATORY core sections and DYNAMIC lab sections.
-
-{self.get_medical_guidelines_prompt()}
-
-EXTRACTED DATA:
-{extracted_data}
-
-PATIENT REGISTRATION:
-{json.dumps(patient_data, indent=2)}
-
-Generate JSON following this EXACT structure:
-
-{{
-  "patient_info": {{
+# Fixed skeleton and rules for the full patient report
+REPORT_SCHEMA_TEMPLATE = """{
+  "patient_info": {
     "name": "string",
     "age": number,
     "gender": "Male/Female/Other",
     "occupation": "string",
     "occupation_activity_classification": "Sedentary/Intermediate/Active",
-    "address": {{"area": "", "locality": "", "city": "", "state": ""}},
+    "address": {"area": "", "locality": "", "city": "", "state": ""},
     "contact": "string",
     "dietary_preference": "Vegetarian/Non-vegetarian/Vegan/Eggetarian",
     "allergies": ["list"],
     "presenting_complaints": "free text"
-  }},
+  },
   
-  "vital_signs": {{
-    "blood_pressure": {{"systolic": number, "diastolic": number, "unit": "mmHg"}},
-    "heart_rate": {{"value": number, "unit": "bpm"}},
-    "respiratory_rate": {{"value": number, "unit": "breaths/min"}},
-    "spo2": {{"value": number, "unit": "%"}},
-    "temperature": {{"value": number, "unit": "°C"}}
-  }},
+  "vital_signs": {
+    "blood_pressure": {"systolic": number, "diastolic": number, "unit": "mmHg"},
+    "heart_rate": {"value": number, "unit": "bpm"},
+    "respiratory_rate": {"value": number, "unit": "breaths/min"},
+    "spo2": {"value": number, "unit": "%"},
+    "temperature": {"value": number, "unit": "°C"}
+  },
   
-  "anthropometric_measurements": {{
-    "height": {{"value": number, "unit": "cm"}},
-    "weight": {{"value": number, "unit": "kg"}},
-    "bmi": {{
+  "anthropometric_measurements": {
+    "height": {"value": number, "unit": "cm"},
+    "weight": {"value": number, "unit": "kg"},
+    "bmi": {
       "value": number,
       "who_classification": "Underweight/Normal/Overweight/Obese",
       "indian_rssdi_classification": "string",
       "interpretation": "string"
-    }}
-  }},
+    }
+  },
   
-  "examination_findings": {{
+  "examination_findings": {
     "general_appearance": "string",
     "cardiovascular": "string",
     "respiratory": "string",
     "abdominal": "string",
     "neurological": "string",
-    "musculoskeletal": {{
+    "musculoskeletal": {
       "joint_issues": ["list"],
       "previous_fractures": ["list"],
       "mobility_limitations": ["list"],
       "deformities": ["list"]
-    }},
-    "lower_limb_vascular_assessment": {{
-      "pulse_grading_svs": {{
-        "femoral": {{"left": "0/1+/2+/3+", "right": "0/1+/2+/3+", "notes": ""}},
-        "popliteal": {{"left": "0/1+/2+/3+", "right": "0/1+/2+/3+", "notes": ""}},
-        "anterior_tibial": {{"left": "0/1+/2+/3+", "right": "0/1+/2+/3+", "notes": ""}},
-        "posterior_tibial": {{"left": "0/1+/2+/3+", "right": "0/1+/2+/3+", "notes": ""}},
-        "dorsalis_pedis": {{"left": "0/1+/2+/3+", "right": "0/1+/2+/3+", "notes": ""}}
-      }},
-      "arterial_findings": {{
+    },
+    "lower_limb_vascular_assessment": {
+      "pulse_grading_svs": {
+        "femoral": {"left": "0/1+/2+/3+", "right": "0/1+/2+/3+", "notes": ""},
+        "popliteal": {"left": "0/1+/2+/3+", "right": "0/1+/2+/3+", "notes": ""},
+        "anterior_tibial": {"left": "0/1+/2+/3+", "right": "0/1+/2+/3+", "notes": ""},
+        "posterior_tibial": {"left": "0/1+/2+/3+", "right": "0/1+/2+/3+", "notes": ""},
+        "dorsalis_pedis": {"left": "0/1+/2+/3+", "right": "0/1+/2+/3+", "notes": ""}
+      },
+      "arterial_findings": {
         "intermittent_claudication": boolean,
         "claudication_distance_meters": number,
         "rest_pain": boolean,
         "skin_changes": ["list"],
         "rutherford_classification": "Class 0-6 with rationale"
-      }},
-      "venous_findings": {{
+      },
+      "venous_findings": {
         "varicose_veins": boolean,
         "edema": "None/Pitting/Brawny",
         "skin_changes": ["list"]
-      }},
-      "lymphatic_findings": {{
+      },
+      "lymphatic_findings": {
         "lymphedema": boolean,
         "severity": "Mild/Moderate/Severe"
-      }},
-      "diabetic_foot_assessment": {{
+      },
+      "diabetic_foot_assessment": {
         "neuropathy": boolean,
         "ulcers": ["list with details"],
         "deformities": ["list"],
         "infection_signs": boolean
-      }},
-      "ulcer_documentation": {{
+      },
+      "ulcer_documentation": {
         "present": boolean,
-        "details": [{{
+        "details": [{
           "site": "", "size": "", "depth": "", "floor": "", 
           "discharge": "", "infection_signs": "", "pain_score": "",
           "exposed_structures": [""], "healing_status": ""
-        }}]
-      }},
-      "skin_assessment": {{
+        }]
+      },
+      "skin_assessment": {
         "color": "normal/pallor/rubor/cyanosis/mottling",
         "temperature": "warm/cool",
         "hair_growth": "normal/reduced/absent",
         "nail_changes": ["list"]
-      }}
-    }},
+      }
+    },
     "other_findings": "string"
-  }},
+  },
   
-  "laboratory_results": {{
+  "laboratory_results": {
     "_note": "DYNAMIC SECTION - Include ONLY lab categories found in actual reports",
     "_instructions": "Create subsections for each lab test category identified (e.g., complete_blood_count, liver_function_tests, renal_function_tests, lipid_profile, thyroid_function, hba1c, electrolytes, etc.)",
     "lab_categories_identified": ["list of actual categories found"],
     
-    "EXAMPLE_complete_blood_count": {{
+    "EXAMPLE_complete_blood_count": {
       "test_date": "YYYY-MM-DD",
-      "hemoglobin": {{"value": number, "unit": "g/dL", "reference_range": "13-17", "status": "normal/high/low"}},
-      "total_wbc": {{"value": number, "unit": "cells/μL", "reference_range": "", "status": ""}},
-      "platelet_count": {{"value": number, "unit": "lakhs/μL", "reference_range": "", "status": ""}},
+      "hemoglobin": {"value": number, "unit": "g/dL", "reference_range": "13-17", "status": "normal/high/low"},
+      "total_wbc": {"value": number, "unit": "cells/μL", "reference_range": "", "status": ""},
+      "platelet_count": {"value": number, "unit": "lakhs/μL", "reference_range": "", "status": ""},
       "_add_all_tests_found": "Include every test with value, unit, range, status"
-    }},
+    },
     
-    "EXAMPLE_lipid_profile": {{
+    "EXAMPLE_lipid_profile": {
       "test_date": "YYYY-MM-DD",
-      "total_cholesterol": {{"value": number, "unit": "mg/dL", "reference_range": "", "status": ""}},
-      "ldl": {{"value": number, "unit": "mg/dL", "reference_range": "", "status": ""}},
-      "hdl": {{"value": number, "unit": "mg/dL", "reference_range": "", "status": ""}},
-      "triglycerides": {{"value": number, "unit": "mg/dL", "reference_range": "", "status": ""}}
-    }},
+      "total_cholesterol": {"value": number, "unit": "mg/dL", "reference_range": "", "status": ""},
+      "ldl": {"value": number, "unit": "mg/dL", "reference_range": "", "status": ""},
+      "hdl": {"value": number, "unit": "mg/dL", "reference_range": "", "status": ""},
+      "triglycerides": {"value": number, "unit": "mg/dL", "reference_range": "", "status": ""}
+    },
     
     "_create_similar_sections": "For ALL lab categories found in the reports",
     
     "abnormal_findings_summary": ["list all abnormal results with clinical significance"],
     "critical_values": ["list any critical/urgent findings"]
-  }},
+  },
   
-  "medical_history_comorbidities": {{
-    "diabetes": {{
+  "medical_history_comorbidities": {
+    "diabetes": {
       "present": boolean,
       "type": "Type 1/Type 2/Gestational/Other",
       "duration_years": number,
       "controlled": boolean,
       "medications": ["list"],
-      "last_hba1c": {{"value": number, "date": "YYYY-MM-DD"}},
-      "last_fbs_rbs": {{"fbs": number, "rbs": number, "unit": "mg/dL"}},
+      "last_hba1c": {"value": number, "date": "YYYY-MM-DD"},
+      "last_fbs_rbs": {"fbs": number, "rbs": number, "unit": "mg/dL"},
       "complications": ["Retinopathy/Nephropathy/Neuropathy"]
-    }},
-    "hypertension": {{
+    },
+    "hypertension": {
       "present": boolean,
       "duration_years": number,
       "controlled": boolean,
       "medications": ["list"],
       "complications": ["list"]
-    }},
-    "dyslipidemia": {{"present": boolean, "controlled": boolean, "medications": ["list"]}},
-    "cardiovascular_disease": {{
+    },
+    "dyslipidemia": {"present": boolean, "controlled": boolean, "medications": ["list"]},
+    "cardiovascular_disease": {
       "ihd": boolean,
       "cad": boolean,
       "type": "string",
       "complications": ["list"]
-    }},
-    "thyroid_disorders": {{
-      "hypothyroidism": {{"present": boolean, "medications": ["list"]}},
-      "hyperthyroidism": {{"present": boolean, "medications": ["list"]}}
-    }},
+    },
+    "thyroid_disorders": {
+      "hypothyroidism": {"present": boolean, "medications": ["list"]},
+      "hyperthyroidism": {"present": boolean, "medications": ["list"]}
+    },
     "other_conditions": ["list all other medical conditions"]
-  }},
+  },
   
-  "substance_use_history": {{
-    "smoking": {{
+  "substance_use_history": {
+    "smoking": {
       "status": "Never/Former/Current",
       "type": "Cigarette/Beedi",
       "quantity_per_day": number,
@@ -441,94 +445,94 @@ Generate JSON following this EXACT structure:
       "smoking_index": number,
       "risk_category": "Low/Moderate/High",
       "abstinence_months": number
-    }},
-    "tobacco_chewing": {{
+    },
+    "tobacco_chewing": {
       "status": boolean,
       "quids_per_day": number,
       "duration_years": number,
       "chewing_index": number,
       "risk_category": "Low/Moderate/High"
-    }},
-    "betel_nut": {{
+    },
+    "betel_nut": {
       "status": boolean,
       "quids_per_day": number,
       "duration_years": number,
       "chewing_index": number,
       "risk_category": "Low/Moderate/High"
-    }},
-    "alcohol": {{"status": "Never/Former/Current", "details": "string"}},
+    },
+    "alcohol": {"status": "Never/Former/Current", "details": "string"},
     "total_tobacco_risk": "Low/Moderate/High with rationale"
-  }},
+  },
   
-  "lifestyle_assessment": {{
-    "occupation_activity": {{
+  "lifestyle_assessment": {
+    "occupation_activity": {
       "occupation": "string",
       "classification": "Sedentary/Intermediate/Active",
       "rationale": "string"
-    }},
-    "physical_activity": {{
-      "daily_steps": {{"value": number, "distance_km": number, "classification": "Below/Meeting/Exceeding recommendations"}},
+    },
+    "physical_activity": {
+      "daily_steps": {"value": number, "distance_km": number, "classification": "Below/Meeting/Exceeding recommendations"},
       "exercise_frequency": "string",
       "exercise_type": ["list"]
-    }},
-    "sleep": {{
+    },
+    "sleep": {
       "duration_hours": number,
       "quality": "Good/Fair/Poor",
       "disturbances": ["list"],
       "classification": "Adequate/Insufficient/Excessive for age",
       "recommendations": "string"
-    }},
-    "diet_habits": {{
+    },
+    "diet_habits": {
       "type": "Vegetarian/Non-vegetarian/Mixed",
       "meal_frequency": number,
       "water_intake_liters": number,
       "concerns": ["list"]
-    }}
-  }},
+    }
+  },
   
-  "risk_stratification": {{
+  "risk_stratification": {
     "components": [
-      {{
+      {
         "category": "ARTERIAL/VENOUS/DIABETIC_FOOT/CARDIOVASCULAR/METABOLIC",
         "risk_level": "Low/Mild/Moderate/High/Critical",
         "findings": ["list specific findings"],
         "rationale": "clinical reasoning"
-      }}
+      }
     ],
     "overall_risk_assessment": "string with comprehensive summary"
-  }},
+  },
   
-  "key_calculations": {{
-    "bmi": {{"value": number, "who": "string", "indian": "string"}},
-    "bmr_mifflin_st_jeor": {{"value": number, "unit": "kcal/day"}},
-    "tdee": {{
+  "key_calculations": {
+    "bmi": {"value": number, "who": "string", "indian": "string"},
+    "bmr_mifflin_st_jeor": {"value": number, "unit": "kcal/day"},
+    "tdee": {
       "sedentary": number,
       "current_activity_level": number,
       "activity_level_used": "string"
-    }},
-    "calorie_deficit_needed": {{
+    },
+    "calorie_deficit_needed": {
       "current_bmi_category": "string",
       "target_daily_calories": number,
       "deficit_amount": number,
       "expected_weight_loss": "0.5-1 kg/week"
-    }},
+    },
     "total_tobacco_risk": "Low/Moderate/High",
     "cardiovascular_risk_score": "if applicable"
-  }},
+  },
   
-  "individualized_diet_plan": {{
+  "individualized_diet_plan": {
     "target_calories": number,
     "calorie_goal": number,
     "unit": "kcal/day",
     "type": "Vegetarian/Non-vegetarian",
-    "macronutrient_distribution": {{
-      "protein": {{"grams": number, "range_gkg": "1.2-2.0", "percentage": "15-20%"}},
-      "carbohydrates": {{"grams": number, "percentage": "45-65%"}},
-      "fat": {{"grams": number, "percentage": "20-35%"}}
-    }},
-    "fluid_intake": {{"target_liters": number, "schedule": "string"}},
+    "macronutrient_distribution": {
+      "protein": {"grams": number, "range_gkg": "1.2-2.0", "percentage": "15-20%"},
+      "carbohydrates": {"grams": number, "percentage": "45-65%"},
+      "fat": {"grams": number, "percentage": "20-35%"}
+    },
+    "fluid_intake": {"target_liters": number, "schedule": "string"},
     "meals": [
-      {{
+      {
         "meal_name": "Breakfast",
         "time": "7:00 AM",
         "foods": "Detailed food list with portions (e.g., Oats porridge 30g, 1 cup skim milk, 8 almonds, 2 walnuts, 1 apple)",
@@ -536,8 +540,8 @@ Generate JSON following this EXACT structure:
         "protein": "Xg",
         "carbs": "Xg",
         "fat": "Xg"
-      }},
-      {{
+      },
+      {
         "meal_name": "Mid-morning",
         "time": "10:00 AM",
         "foods": "Specific foods",
@@ -545,8 +549,8 @@ Generate JSON following this EXACT structure:
         "protein": "Xg",
         "carbs": "Xg",
         "fat": "Xg"
-      }},
-      {{
+      },
+      {
         "meal_name": "Lunch",
         "time": "1:00 PM",
         "foods": "Complete meal description",
@@ -554,8 +558,8 @@ Generate JSON following this EXACT structure:
         "protein": "Xg",
         "carbs": "Xg",
         "fat": "Xg"
-      }},
-      {{
+      },
+      {
         "meal_name": "Evening Snack",
         "time": "4:00 PM",
         "foods": "Specific foods",
@@ -563,8 +567,8 @@ Generate JSON following this EXACT structure:
         "protein": "Xg",
         "carbs": "Xg",
         "fat": "Xg"
-      }},
-      {{
+      },
+      {
         "meal_name": "Dinner",
         "time": "7:00 PM",
         "foods": "Complete meal description",
@@ -572,14 +576,14 @@ Generate JSON following this EXACT structure:
         "protein": "Xg",
         "carbs": "Xg",
         "fat": "Xg"
-      }}
+      }
     ],
-    "daily_totals": {{
+    "daily_totals": {
       "calories": number,
       "protein": "Xg",
       "carbs": "Xg",
       "fat": "Xg"
-    }},
+    },
     "notes": [
       "Adjust portion sizes to reach calorie goal of X kcal/day",
       "Consider patient allergies: [list]",
@@ -588,18 +592,18 @@ Generate JSON following this EXACT structure:
       "Local dietary habits incorporated"
     ],
     "weekly_variation": "Rotate proteins, vary vegetables, alternate grains for variety"
-  }},
+  },
   
-  "exercise_physiotherapy_plan": {{
-    "considerations": {{
+  "exercise_physiotherapy_plan": {
+    "considerations": {
       "mobility_limitations": ["list"],
       "joint_issues": ["list"],
       "previous_fractures": ["list"],
       "contraindications": ["list"],
       "current_fitness_level": "Sedentary/Beginner/Intermediate"
-    }},
+    },
     "recommended_program": [
-      {{
+      {
         "activity_type": "Walking Program",
         "description": "Start 15-20 minutes daily, gradually increase to 30-45 minutes",
         "frequency": "5-7 days/week",
@@ -607,27 +611,27 @@ Generate JSON following this EXACT structure:
         "duration": "15-45 minutes",
         "progression": "Increase by 5 minutes weekly",
         "modifications": "If claudication occurs, rest until pain subsides, then continue"
-      }},
-      {{
+      },
+      {
         "activity_type": "Interval Training",
         "description": "Alternate walking speeds if tolerated",
         "frequency": "3 times/week",
         "modifications": "Based on symptoms"
-      }},
-      {{
+      },
+      {
         "activity_type": "Resistance Training",
         "description": "Light weights or body weight exercises",
         "exercises": ["Wall push-ups", "Chair squats", "Seated leg raises"],
         "frequency": "2-3 times/week",
         "modifications": "Avoid if severe joint pain"
-      }},
-      {{
+      },
+      {
         "activity_type": "Flexibility & Balance",
         "description": "Gentle stretching and balance exercises",
         "exercises": ["Ankle circles", "Calf stretches", "Standing balance"],
         "frequency": "Daily",
         "duration": "10-15 minutes"
-      }}
+      }
     ],
     "warm_up": "5 minutes gentle stretching/breathing",
     "cool_down": "5 minutes gentle stretching",
@@ -640,42 +644,42 @@ Generate JSON following this EXACT structure:
       "Exercise in safe, well-lit areas",
       "Monitor blood sugar if diabetic"
     ]
-  }},
+  },
   
-  "management_advice_triggers": {{
-    "diabetes": {{
+  "management_advice_triggers": {
+    "diabetes": {
       "status": "Uncontrolled/Controlled/Not present",
       "action": "Immediate endocrinology referral/start treatment" OR "Continue current management"
-    }},
-    "hypertension": {{
+    },
+    "hypertension": {
       "status": "string",
       "action": "specific recommendation"
-    }},
-    "foot_care": {{
+    },
+    "foot_care": {
       "status": "At risk/Ulcer present/Normal",
       "action": "NO home cutting of nails/calluses, no heat pads, daily inspection required"
-    }},
-    "tobacco_cessation": {{
+    },
+    "tobacco_cessation": {
       "status": "Active use/Former/Never",
       "action": "Increased vascular risk counseling, cessation support, de-addiction clinic referral"
-    }},
-    "medication_adherence": {{
+    },
+    "medication_adherence": {
       "status": "string",
       "action": "Review all comorbidity medications, ensure regular follow-up"
-    }},
-    "wound_care": {{
+    },
+    "wound_care": {
       "present": boolean,
       "action": "Specific care: moisture, moisturization, proper footwear"
-    }},
+    },
     "lifestyle_modifications": [
       "Graded walking program as tolerated",
       "Immediate specialty review (see referrals)",
       "Strict foot care protocol and self-monitoring"
     ],
     "additional_advice": "All risk/plan details included above, follow international guidelines"
-  }},
+  },
   
-  "red_flags_emergency_return": {{
+  "red_flags_emergency_return": {
     "seek_immediate_medical_attention_if": [
       "Sudden severe chest pain or pressure",
       "Difficulty breathing or shortness of breath at rest",
@@ -689,22 +693,22 @@ Generate JSON following this EXACT structure:
       "Loss of consciousness or severe dizziness",
       "New or worsening claudication significantly limiting walking"
     ]
-  }},
+  },
   
-  "follow_up_plan": {{
+  "follow_up_plan": {
     "next_appointment": "Timeframe (e.g., 2 weeks, 1 month)",
     "specialty_clinic_referrals": [
-      {{"clinic": "Endocrinology", "reason": "Uncontrolled diabetes, medication initiation/adjustment", "urgency": "Immediate/Routine"}},
-      {{"clinic": "Dietitian/Nutritionist", "reason": "Personalized meal planning, comorbidity management, weight optimization", "urgency": ""}},
-      {{"clinic": "De-addiction/Psychiatry", "reason": "Smoking/tobacco cessation support, substance use counseling", "urgency": ""}},
-      {{"clinic": "Vascular Surgery", "reason": "If critical limb ischemia or severe PAD", "urgency": ""}},
-      {{"clinic": "Podiatry/Wound Care", "reason": "If diabetic foot ulcers present", "urgency": ""}}
+      {"clinic": "Endocrinology", "reason": "Uncontrolled diabetes, medication initiation/adjustment", "urgency": "Immediate/Routine"},
+      {"clinic": "Dietitian/Nutritionist", "reason": "Personalized meal planning, comorbidity management, weight optimization", "urgency": ""},
+      {"clinic": "De-addiction/Psychiatry", "reason": "Smoking/tobacco cessation support, substance use counseling", "urgency": ""},
+      {"clinic": "Vascular Surgery", "reason": "If critical limb ischemia or severe PAD", "urgency": ""},
+      {"clinic": "Podiatry/Wound Care", "reason": "If diabetic foot ulcers present", "urgency": ""}
     ],
     "investigations_required": [
-      {{"test": "HbA1c", "timing": "Every 3 months", "indication": "Diabetes monitoring"}},
-      {{"test": "Lipid profile", "timing": "Every 6 months", "indication": "CVD risk"}},
-      {{"test": "ABI (Ankle-Brachial Index)", "timing": "If not done or symptoms worsen", "indication": "PAD assessment"}},
-      {{"test": "Doppler ultrasound", "timing": "As per vascular specialist", "indication": "Arterial assessment"}}
+      {"test": "HbA1c", "timing": "Every 3 months", "indication": "Diabetes monitoring"},
+      {"test": "Lipid profile", "timing": "Every 6 months", "indication": "CVD risk"},
+      {"test": "ABI (Ankle-Brachial Index)", "timing": "If not done or symptoms worsen", "indication": "PAD assessment"},
+      {"test": "Doppler ultrasound", "timing": "As per vascular specialist", "indication": "Arterial assessment"}
     ],
     "medication_review": "Review all comorbidity medications, ensure adherence, adjust as per specialist recommendations",
     "self_monitoring": [
@@ -714,13 +718,13 @@ Generate JSON following this EXACT structure:
       "Weight tracking weekly",
       "Exercise log maintenance"
     ]
-  }},
+  },
   
-  "integrated_report_summary": {{
-    "patient": {{
+  "integrated_report_summary": {
+    "patient": {
       "demographics": "Age, gender, occupation details",
       "dietary_preference": "Vegetarian/Non-vegetarian"
-    }},
+    },
     "main_problems": "Primary diagnoses and key concerns (e.g., Uncontrolled diabetes, PAD, obesity)",
     "critical_findings": "Any urgent/critical findings requiring immediate attention" OR null,
     "care_plan_summary": [
@@ -735,24 +739,24 @@ Generate JSON following this EXACT structure:
     "advisor": "AI Medical Assistant",
     "supervising_physician": "Report to be reviewed and co-signed by attending physician",
     "data_quality_assessment": "Complete/Partial data available, OCR extraction quality assessment"
-  }},
+  },
   
   "referrals_suggested": [
-    {{
+    {
       "specialty": "Endocrinology",
       "reason": "Uncontrolled diabetes, medication initiation/adjustment required",
       "urgency": "Immediate"
-    }},
-    {{
+    },
+    {
       "specialty": "Dietitian/Nutritionist",
       "reason": "Personalized meal planning, comorbidity management, weight optimization",
       "urgency": "Routine"
-    }},
-    {{
+    },
+    {
       "specialty": "De-addiction Clinic/Psychiatry",
       "reason": "Smoking/tobacco cessation support, substance use counseling",
       "urgency": "Routine"
-    }}
+    }
   ],
   
   "additional_recommendations": [
@@ -763,7 +767,7 @@ Generate JSON following this EXACT structure:
     "Regular follow-up adherence critical for outcomes"
   ],
   
-  "report_metadata": {{
+  "report_metadata": {
     "generation_timestamp": "ISO timestamp",
     "files_analyzed": ["list of cloudinary URLs and file types"],
     "extraction_methods": ["OCR", "PDF text extraction", "Image analysis"],
@@ -779,8 +783,8 @@ Generate JSON following this EXACT structure:
       "ESC Cardiovascular Guidelines",
       "International Tobacco Control Guidelines"
     ]
-  }}
-}}
+  }
+}
 
 CRITICAL INSTRUCTIONS:
 1. **CALCULATE ALL METRICS** where data exists using exact formulas
@@ -792,27 +796,607 @@ CRITICAL INSTRUCTIONS:
 7. **PULSE GRADING**: Use SVS scale (0, 1+, 2+, 3+) for all documented pulses
 8. **RISK STRATIFICATION**: Separate arterial, venous, lymphatic, diabetic foot risks
 9. **REFERRALS**: List specific specialties with clear reasons
-10. **RED FLAGS**: Comprehensive list of emergency signs
+10. **RED FLAGS**: Comprehensive list of emergency signs"""
 
-Return ONLY valid JSON, no markdown."""
+# Everything static about a report request, kept byte-identical across calls so
+# OpenAI's automatic prompt caching can reuse it; per-patient data goes after it.
+_REPORT_SYSTEM_PROMPT = f"""You are an expert medical report generator with OCR analysis capabilities and comprehensive knowledge of international clinical guidelines. You excel at creating detailed, evidence-based reports with accurate calculations and practical recommendations. You adapt lab result sections dynamically based on actual test results present.
 
-        report_messages = [
+{_GUIDELINES_PROMPT}
+
+EXTRACTION PROTOCOL:
+1. Extract ALL patient demographics, biometrics, vitals
+2. Identify ALL laboratory test categories present (e.g., CBC, LFT, RFT, Lipid Profile, Thyroid, HbA1c, Electrolytes, Hormones, Tumor Markers, etc.)
+3. Extract ALL lab values with units and reference ranges
+4. Extract ALL physical examination findings
+5. Extract ALL medical history and comorbidities
+6. Extract ALL substance use history with quantities
+7. Extract ALL lifestyle data (occupation, activity, sleep, diet, steps)
+8. Extract ALL lower limb vascular findings
+9. Extract ALL medications and allergies
+
+IMPORTANT: For lab results, identify the EXACT test categories present in the documents, don't assume standard categories.
+
+REPORT STRUCTURE - generate JSON following this EXACT structure:
+
+{REPORT_SCHEMA_TEMPLATE}"""
+
+# Static instructions for the report stage of single-document analyses (single
+# and batched). The guidelines were already applied by the extraction stage.
+_FILE_REPORT_SYSTEM_PROMPT = """You are an expert medical document analyzer. Create focused, dynamically-structured analyses based on document content with accurate calculations.
+
+The extracted data was prepared following the clinical guidelines: keep its lab categories and classifications.
+Use the standard clinical formulas and classifications (WHO BMI, Mifflin-St Jeor) for any calculations.
+
+Each document analysis is a JSON object with:
+1. **document_info**: Type, date, source
+2. **patient_info**: If available from document
+3. **laboratory_results**: DYNAMIC - create subsections for each actual lab category found
+4. **vital_signs**: If present
+5. **clinical_findings**: Any examination findings
+6. **calculations**: Perform BMI, etc. if height/weight present
+7. **interpretations**: Clinical significance of findings
+8. **recommendations**: Based on results
+9. **integrated_summary**: Key findings and next steps
+
+IMPORTANT: 
+- Create lab subsections dynamically based on actual categories in each document
+- Use exact formulas for any calculations possible
+- Flag abnormal/critical values
+- Provide clinical interpretations"""
+
+
+class ServiceBusyError(Exception):
+    """Raised when too many requests are already queued for OpenAI capacity."""
+
+
+class MedicalReportService:
+    # Extraction only restructures OCR/PDF text, so it runs on the cheaper, faster
+    # model; clinical reasoning and report generation need the full one. Both can
+    # be changed through settings, or per instance for A/B runs.
+    EXTRACTION_MODEL = settings.EXTRACTION_MODEL
+    REPORT_MODEL = settings.REPORT_MODEL
+
+    def __init__(self):
+        # retries are done by _retry_openai, with backoff that releases the limiter slot
+        self.openai_client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY, max_retries=0)
+        self.base_url = settings.BASE_URL
+        self.temp_dir = Path("temp_medical_files")
+        self.temp_dir.mkdir(exist_ok=True)
+        self.temp_dir_str = str(self.temp_dir)
+        # extracted PDF/OCR text, keyed by file content hash, survives re-analyses
+        self.text_cache_dir = self.temp_dir / "text_cache"
+        self.text_cache_dir.mkdir(exist_ok=True)
+        self.report_cache = ResponseCache(maxsize=1024, ttl=3600)
+        self.file_analysis_cache = ResponseCache(maxsize=1024, ttl=3600)
+        # patient records are re-read on every (re)generation; a short TTL keeps them fresh
+        self.patient_cache = ResponseCache(maxsize=512, ttl=60)
+        # completed (non-streaming) chat responses by hash of the exact request
+        self.completion_cache = ResponseCache(maxsize=256, ttl=3600)
+        self._patient_locks: Dict[str, asyncio.Lock] = {}
+        # coalesces concurrent single-file analyses into one OpenAI request pair;
+        # off by default since it puts different users' documents in one prompt
+        self.file_batch_queue: Optional[AsyncBatchQueue] = None
+        if settings.FILE_BATCH_SIZE > 1:
+            self.file_batch_queue = AsyncBatchQueue(
+                self.analyze_files_batch,
+                max_batch_size=min(settings.FILE_BATCH_SIZE, FILE_BATCH_MAX),
+                max_wait_time=0.1,
+                max_concurrent_batches=settings.OPENAI_CONCURRENCY,
+            )
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._pdf_pool: Optional[ProcessPoolExecutor] = None
+        # one in-process tesseract engine per worker thread (the API is not thread-safe)
+        self._tess_local = threading.local()
+        self._easyocr_reader = None
+        self._easyocr_lock = threading.Lock()
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Return the shared HTTP session, creating it on first use so connections are pooled."""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=64, limit_per_host=16, ttl_dns_cache=300, keepalive_timeout=60)
+            )
+        return self._session
+
+    async def close(self) -> None:
+        """Close the shared HTTP session, PDF worker pool and batch queue (call on app shutdown)."""
+        if self.file_batch_queue is not None:
+            await self.file_batch_queue.stop()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        if self._pdf_pool is not None:
+            self._pdf_pool.shutdown(wait=False, cancel_futures=True)
+            self._pdf_pool = None
+
+    def _get_pdf_pool(self) -> ProcessPoolExecutor:
+        if self._pdf_pool is None:
+            # forkserver: forking this multi-threaded process (to_thread workers,
+            # OCR threads, CUDA) could leave children holding copied locks
+            self._pdf_pool = ProcessPoolExecutor(
+                max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("forkserver")
+            )
+        return self._pdf_pool
+
+    async def fetch_patient_data(self, user_id: str) -> Dict[str, Any]:
+        """Fetch a patient record, served from a 60s cache.
+
+        Concurrent requests for the same uncached patient share a single fetch.
+        """
+        patient = self.patient_cache.get(user_id)
+        if patient is not None:
+            return patient
+
+        lock = self._patient_locks.setdefault(user_id, asyncio.Lock())
+        try:
+            async with lock:
+                patient = self.patient_cache.get(user_id)
+                if patient is None:
+                    patient = await self._fetch_patient_data(user_id)
+                    self.patient_cache.set(user_id, patient)
+                return patient
+        finally:
+            if not lock.locked():
+                self._patient_locks.pop(user_id, None)
+
+    async def _fetch_patient_data(self, user_id: str) -> Dict[str, Any]:
+        url = f"{self.base_url}/patient-registration/{user_id}"
+        session = await self._get_session()
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=30)) as response:
+            response.raise_for_status()
+            return await response.json(loads=orjson.loads)
+
+    def extract_cloudinary_urls(self, data: Dict[str, Any]) -> List[Dict[str, str]]:
+        """Extract all cloudinary URLs from the patient data structure, in document order.
+
+        A URL referenced from several fields is reported once, under its first field.
+        """
+        urls = []
+        seen = set()
+        # iterative depth-first walk; children are pushed reversed so they pop in
+        # order. Paths are kept as key/index tuples and only formatted for hits.
+        stack = deque([(data, ())])
+        
+        while stack:
+            obj, path = stack.pop()
+            obj_type = type(obj)
+            if obj_type is dict:
+                stack.extend(reversed([(v, path + (k,)) for k, v in obj.items()]))
+            elif obj_type is list:
+                stack.extend(reversed([(item, path + (i,)) for i, item in enumerate(obj)]))
+            elif obj_type is str and len(obj) >= _CLOUDINARY_HOST_LEN and _CLOUDINARY_HOST in obj and obj not in seen:
+                seen.add(obj)
+                urls.append({
+                    "url": obj,
+                    "field": _field_path(path),
+                    "type": self._guess_type(obj)
+                })
+        
+        return urls
+
+    def _guess_type(self, url: str) -> str:
+        match = _TYPE_RE.search(url)
+        if match is not None:
+            return _EXT_TYPES[match.group(1).lower()]
+        # extension-less delivery URLs, e.g. .../image/upload/v123/abc
+        match = _KIND_RE.search(url)
+        if match is not None:
+            return match.group(1).lower()
+        return "unknown"
+
+    @_retry_download
+    async def download_file(self, url: str, filename: str, dest_dir: Optional[Path] = None) -> Optional[Path]:
+        async with DOWNLOAD_LIMITER:
+            session = await self._get_session()
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=60)) as response:
+                response.raise_for_status()
+                file_path = (dest_dir or self.temp_dir) / filename
+                # stream to disk so memory stays bounded by one write buffer, not the file
+                # size; unbuffered fd writes of up to 1 MiB keep syscalls and thread hops low
+                fd = await asyncio.to_thread(os.open, file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                try:
+                    buf = bytearray()
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        buf += chunk
+                        if len(buf) >= DOWNLOAD_WRITE_SIZE:
+                            data, buf = buf, bytearray()
+                            await asyncio.to_thread(_write_all, fd, data)
+                    if buf:
+                        await asyncio.to_thread(_write_all, fd, buf)
+                finally:
+                    await asyncio.to_thread(os.close, fd)
+                return file_path
+
+    async def download_files(
+        self, items: List[Dict[str, str]], concurrency: int = 8, dest_dir: Optional[Path] = None
+    ) -> List[Any]:
+        """Download many files concurrently, at most `concurrency` at a time.
+
+        Returns one entry per item, in order: the downloaded path, or the exception
+        raised for that item.
+        """
+        sem = asyncio.Semaphore(concurrency)
+
+        async def one(url: str, filename: str) -> Optional[Path]:
+            async with sem:
+                return await self.download_file(url, filename, dest_dir)
+
+        return await asyncio.gather(
+            *(one(i['url'], i['filename']) for i in items), return_exceptions=True
+        )
+
+    async def encode_image_to_base64(self, image_path: Path) -> str:
+        def _encode():
+            # encode straight from a memory map: the raw file is never copied onto
+            # the heap and the encoding is built in one allocation, no regrowth
+            with open(image_path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return ""
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    return base64.b64encode(mm).decode("ascii")
+        
+        return await asyncio.to_thread(_encode)
+
+    async def extract_text_from_pdf(self, pdf_path: Path) -> str:
+        """Extract text from PDF using pypdfium2, falling back to PyPDF2."""
+        if not PDF_TEXT_AVAILABLE:
+            return ""
+        
+        path = str(pdf_path)
+        try:
+            num_pages = await asyncio.to_thread(pdf_page_count, path)
+            if num_pages <= PDF_PARALLEL_MIN_PAGES or (os.cpu_count() or 1) < 2:
+                # not worth the inter-process overhead for short documents
+                pages = await asyncio.to_thread(extract_pdf_page_range, path, 0, num_pages)
+            else:
+                # text extraction is CPU-bound, so split page ranges across processes
+                workers = min(os.cpu_count() or 1, num_pages)
+                step = -(-num_pages // workers)
+                loop = asyncio.get_running_loop()
+                pool = self._get_pdf_pool()
+                chunks = await asyncio.gather(*(
+                    loop.run_in_executor(pool, extract_pdf_page_range, path, start, min(start + step, num_pages))
+                    for start in range(0, num_pages, step)
+                ))
+                pages = [text for chunk in chunks for text in chunk]
+
+            return "\n".join(page_text or "" for page_text in pages)
+        except Exception as e:
+            print(f"Error extracting PDF text: {e}")
+            return ""
+
+    async def extract_text_from_files(self, files: List[Dict[str, Any]]) -> str:
+        """Extract text from all downloaded files (images + PDFs) using OCR."""
+        extracted_texts: List[str] = []
+
+        # identical file content was already extracted on an earlier run
+        keys, texts = await asyncio.to_thread(self._load_cached_texts, files)
+        fresh: Dict[str, str] = {}
+
+        # OCR all uncached images in one go, concurrently with the uncached PDF
+        # extractions, then assemble results in file order
+        image_indexes = [i for i, f in enumerate(files) if f.get('type') == 'image' and f.get('path') and i not in texts]
+        pdf_indexes = [i for i, f in enumerate(files) if f.get('type') == 'pdf' and f.get('path') and i not in texts]
+        ocr_texts, *pdf_texts = await asyncio.gather(
+            self._ocr_images([files[i]['path'] for i in image_indexes]),
+            *(self.extract_text_from_pdf(files[i]['path']) for i in pdf_indexes),
+        )
+        for i, text in zip(image_indexes + pdf_indexes, ocr_texts + pdf_texts):
+            texts[i] = text
+            fresh[keys[i]] = text
+        
+        for i, f in enumerate(files):
+            try:
+                if f.get('type') == 'pdf' and f.get('path'):
+                    text = texts.get(i, "")
+                    if text and text.strip():
+                        extracted_texts.append(f"--- Text from {f['field']} (PDF) ---\n{text}")
+                elif f.get('type') == 'image' and 'error' not in f:
+                    ocr_text = texts.get(i, "")
+
+                    if ocr_text and ocr_text.strip():
+                        extracted_texts.append(f"--- OCR text from {f['field']} (IMAGE) ---\n{ocr_text}")
+                    else:
+                        extracted_texts.append(f"--- Image file included: {f['field']} (OCR not available) ---")
+                else:
+                    if 'error' not in f:
+                        extracted_texts.append(f"--- File included: {f['field']} (type: {f.get('type')}) ---")
+            except Exception as e:
+                print(f"Error extracting text from {f.get('field')}: {e}")
+
+        # empty results may be transient failures (or OCR being unavailable), so only text is kept
+        fresh = {key: text for key, text in fresh.items() if text}
+        if fresh:
+            await asyncio.to_thread(self._store_cached_texts, fresh)
+
+        return "\n".join(extracted_texts)
+
+    def _load_cached_texts(self, files: List[Dict[str, Any]]) -> Tuple[List[Optional[str]], Dict[int, str]]:
+        """Hash each extractable file and load its cached text (run in thread).
+
+        Returns the cache key per file (None if not extractable) and the cached
+        texts by file index.
+        """
+        keys: List[Optional[str]] = [None] * len(files)
+        texts: Dict[int, str] = {}
+        for i, f in enumerate(files):
+            if f.get('type') not in ('pdf', 'image') or not f.get('path'):
+                continue
+            try:
+                keys[i] = f"{file_digest(f['path'])}.{f['type']}.v{TEXT_CACHE_VERSION}"
+                texts[i] = _read_cached_text(self.text_cache_dir / f"{keys[i]}.txt")
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"Text cache lookup failed for {f.get('field')}: {e}")
+        return keys, texts
+
+    def _store_cached_texts(self, texts: Dict[str, str]) -> None:
+        """Persist extracted texts by cache key (run in thread)."""
+        for key, text in texts.items():
+            if key is None:
+                continue
+            path = self.text_cache_dir / f"{key}.txt"
+            tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            try:
+                tmp.write_bytes(text.encode("utf-8"))
+                # atomic, so concurrent readers never see a partial file
+                os.replace(tmp, path)
+            except Exception as e:
+                print(f"Failed to cache extracted text {key}: {e}")
+                tmp.unlink(missing_ok=True)
+
+    async def _ocr_images(self, paths: List[Path]) -> List[str]:
+        """OCR images, returning one text per path ("" where OCR is unavailable or fails).
+
+        Uses one batched EasyOCR call on the GPU when available, otherwise tesseract
+        concurrently: it is CPU-bound and releases the GIL, so several calls can use
+        different cores at once.
+        """
+        if not paths:
+            return []
+
+        if EASYOCR_GPU:
+            try:
+                return await asyncio.to_thread(self._ocr_images_gpu, paths)
+            except Exception as e:
+                print(f"GPU OCR failed, falling back to tesseract: {e}")
+
+        if Image is None or (tesserocr is None and pytesseract is None):
+            return [""] * len(paths)
+
+        sem = asyncio.Semaphore(os.cpu_count() or 1)
+
+        async def _ocr(path: Path) -> str:
+            async with sem:
+                try:
+                    return await asyncio.to_thread(self._ocr_image, path)
+                except Exception as e:
+                    print(f"Image OCR failed for {path}: {e}")
+                    return ""
+
+        return list(await asyncio.gather(*(_ocr(p) for p in paths)))
+
+    def _ocr_images_gpu(self, paths: List[Path]) -> List[str]:
+        """Batch-OCR images with EasyOCR on CUDA (run in thread)."""
+        with self._easyocr_lock:
+            if self._easyocr_reader is None:
+                reader = easyocr.Reader(['en'], gpu=True, cudnn_benchmark=True)
+                # warm up the CUDA kernels before the first real batch
+                reader.readtext(np.zeros((64, 64, 3), dtype=np.uint8))
+                self._easyocr_reader = reader
+            # readtext_batched resizes every image to n_width x n_height
+            results = self._easyocr_reader.readtext_batched(
+                [str(p) for p in paths], n_width=1600, n_height=1200, batch_size=8, detail=0
+            )
+        return ["\n".join(lines) for lines in results]
+
+    def _ocr_image(self, image_path: Path) -> str:
+        """Helper method for OCR to be run in thread.
+
+        Prefers tesserocr, which keeps the model loaded between calls, over
+        pytesseract, which starts a tesseract process for every image.
+        """
+        img = _prepare_for_ocr(Image.open(image_path))
+        if tesserocr is not None:
+            api = getattr(self._tess_local, "api", None)
+            if api is None:
+                api = tesserocr.PyTessBaseAPI(psm=tesserocr.PSM.SINGLE_BLOCK, oem=tesserocr.OEM.LSTM_ONLY)
+                self._tess_local.api = api
+            api.SetImage(img)
+            return api.GetUTF8Text()
+        return pytesseract.image_to_string(img, config=TESSERACT_CONFIG)
+
+    async def _chat_completion(self, **kwargs: Any) -> Any:
+        """Run a chat completion under the shared OpenAI capacity limiter.
+
+        Fails fast with ServiceBusyError instead of queueing indefinitely once
+        OPENAI_MAX_WAITING requests are already waiting for a slot. A request
+        identical to an earlier one (same model, messages and parameters) is
+        answered from completion_cache without calling OpenAI.
+        """
+        cache_key = None
+        if not kwargs.get("stream"):
+            cache_key = content_hash(orjson.dumps(kwargs, option=orjson.OPT_SORT_KEYS)).hexdigest()
+            cached = self.completion_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        if OPENAI_LIMITER.statistics().tasks_waiting >= settings.OPENAI_MAX_WAITING:
+            raise ServiceBusyError("Too many report requests in progress, please retry shortly")
+        # OpenAI fetches image URLs itself and rejects the whole request if one
+        # cannot be downloaded: retry without the image(s) it could not reach
+        request = kwargs
+        while True:
+            try:
+                response = await self._create_completion(**request)
+                break
+            except openai.BadRequestError as e:
+                if e.code != "invalid_image_url":
+                    raise
+                urls = _IMAGE_URL_RE.findall(e.message)
+                messages = _without_image_urls(request["messages"], urls)
+                if messages is None and urls:
+                    # the quoted URL did not match a block exactly: drop every remote image
+                    messages = _without_image_urls(request["messages"], [])
+                if messages is None:
+                    raise
+                print(f"Retrying without unreachable image(s): {e.message}")
+                request = {**request, "messages": messages}
+
+        # truncated or filtered output must not be replayed to a retry, and a
+        # reply that is missing images must not answer the full request later
+        if (cache_key is not None and request is kwargs
+                and response.choices and response.choices[0].finish_reason == "stop"):
+            self.completion_cache.set(cache_key, response)
+        return response
+
+    @_retry_openai
+    async def _create_completion(self, **kwargs: Any) -> Any:
+        async with OPENAI_LIMITER:
+            return await self.openai_client.chat.completions.create(**kwargs)
+
+    @staticmethod
+    @_retry_openai
+    async def _batch_api_call(method: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> Any:
+        """Call a Batch API client method, retrying transient failures (the client itself never retries)."""
+        return await method(*args, **kwargs)
+
+    def get_medical_guidelines_prompt(self) -> str:
+        """Return comprehensive medical guidelines for AI analysis."""
+        return _GUIDELINES_PROMPT
+
+    async def analyze_with_openai(self, patient_data: Dict[str, Any], files: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Dynamic analysis with mandatory core sections + flexible lab sections."""
+        report_messages = await self.build_report_messages(patient_data, files)
+
+        resp2 = await self._chat_completion(
+            model=self.REPORT_MODEL,
+            messages=report_messages,
+            temperature=0.2,
+            max_tokens=8000,
+            response_format={"type": "json_object"}
+        )
+        
+        return orjson.loads(resp2.choices[0].message.content)
+
+    async def build_report_messages(self, patient_data: Dict[str, Any], files: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Build the messages for the single extraction + report generation call."""
+        
+        # Extraction and report generation are fused into one request: the model
+        # extracts internally and returns only the final report JSON. Static
+        # instructions come first and the per-patient data last, so the shared
+        # prefix is served from OpenAI's prompt cache.
+        report_prompt = """Generate a COMPREHENSIVE medical report with MANDATORY core sections and DYNAMIC lab sections from the sources below.
+
+Work in two steps:
+STEP 1 - EXTRACTION (internal, do not output): following the EXTRACTION PROTOCOL, extract ALL medical information from the registration data, the extracted text and the attached images, identifying the EXACT lab test categories present.
+STEP 2 - REPORT: using that extraction, generate JSON following the EXACT REPORT STRUCTURE and CRITICAL INSTRUCTIONS above.
+
+Return ONLY the final report JSON (no extraction notes), no markdown."""
+
+        return [
             {
                 "role": "system", 
-                "content": "You are an expert medical report generator with comprehensive knowledge of international clinical guidelines. You excel at creating detailed, evidence-based reports with accurate calculations and practical recommendations. You adapt lab result sections dynamically based on actual test results present."
+                "content": _REPORT_SYSTEM_PROMPT
             },
-            {"role": "user", "content": report_prompt}
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": report_prompt},
+                    *await self._report_sources(patient_data, files)
+                ]
+            }
         ]
 
-        resp2 = await self.openai_client.chat.completions.create(
-            model="gpt-4o",
-            messages=report_messages,
+    async def _report_sources(self, patient_data: Dict[str, Any], files: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Content blocks with one patient's registration data, extracted file text and images."""
+        
+        # Extract text from all files with OCR
+        extracted_text = await self.extract_text_from_files(files)
+        patient_json = orjson.dumps(patient_data, option=orjson.OPT_INDENT_2, default=str).decode()
+
+        content: List[Dict[str, Any]] = [{
+            "type": "text",
+            "text": f"""PATIENT REGISTRATION DATA:
+{patient_json}
+
+EXTRACTED TEXT FROM ALL FILES (PDF & OCR):
+{extracted_text}"""
+        }]
+        
+        # Add all images for visual analysis; OpenAI fetches them from Cloudinary itself,
+        # so a failed local (OCR) download does not matter here. Unreachable images
+        # are dropped by _chat_completion if OpenAI rejects them.
+        for f in files:
+            if f['type'] == 'image':
+                content.append({
+                    "type": "image_url",
+                    "image_url": {"url": f['url']}
+                })
+
+        return content
+
+    async def analyze_batch(
+        self, patients: List[Tuple[Dict[str, Any], List[Dict[str, Any]]]], max_batch_size: int = 2
+    ) -> List[Dict[str, Any]]:
+        """Analyze several patients with one OpenAI call per group of `max_batch_size`.
+
+        `patients` holds (patient_data, downloaded files) pairs; one analysis is
+        returned per patient, in order. Each full report is several thousand
+        output tokens, so groups stay small to fit the model's output limit. A
+        group whose response cannot be split back into one report per patient is
+        analyzed patient by patient instead.
+        """
+        groups = [patients[i:i + max_batch_size] for i in range(0, len(patients), max_batch_size)]
+        results = await asyncio.gather(*(self._analyze_patient_group(group) for group in groups))
+        return [analysis for group in results for analysis in group]
+
+    async def _analyze_patient_group(
+        self, patients: List[Tuple[Dict[str, Any], List[Dict[str, Any]]]]
+    ) -> List[Dict[str, Any]]:
+        if len(patients) == 1:
+            return [await self.analyze_with_openai(*patients[0])]
+
+        user_content: List[Dict[str, Any]] = [{
+            "type": "text",
+            "text": f"""Generate one COMPREHENSIVE medical report with MANDATORY core sections and DYNAMIC lab sections for EACH of these {len(patients)} patients.
+They are DIFFERENT patients - never mix information between them.
+
+For every patient work in two steps:
+STEP 1 - EXTRACTION (internal, do not output): following the EXTRACTION PROTOCOL, extract ALL medical information from that patient's registration data, extracted text and attached images, identifying the EXACT lab test categories present.
+STEP 2 - REPORT: using that extraction, generate the patient's report following the EXACT REPORT STRUCTURE and CRITICAL INSTRUCTIONS above.
+
+Return JSON of the form {{"reports": [ ... ]}} with EXACTLY {len(patients)} report objects, in PATIENT order.
+Return ONLY the final JSON (no extraction notes), no markdown."""
+        }]
+        sources = await asyncio.gather(*(self._report_sources(p, files) for p, files in patients))
+        for i, content in enumerate(sources):
+            user_content.append({"type": "text", "text": f"### PATIENT {i + 1}"})
+            user_content.extend(content)
+
+        resp = await self._chat_completion(
+            model=self.REPORT_MODEL,
+            messages=[
+                {"role": "system", "content": _REPORT_SYSTEM_PROMPT},
+                {"role": "user", "content": user_content}
+            ],
             temperature=0.2,
-            max_tokens=8000,
+            max_tokens=16384,
             response_format={"type": "json_object"}
         )
-        
-        return json.loads(resp2.choices[0].message.content)
+
+        try:
+            reports = orjson.loads(resp.choices[0].message.content).get("reports")
+        except Exception as e:
+            print(f"Error parsing batched reports: {e}")
+            reports = None
+
+        if not isinstance(reports, list) or len(reports) != len(patients):
+            print("Batched reports could not be split per patient, analyzing individually")
+            return list(await asyncio.gather(*(self.analyze_with_openai(p, files) for p, files in patients)))
+
+        return reports
 
     async def analyze_file_only(self, file_path: Path, file_type: str) -> Dict[str, Any]:
         """Analyze a single file with comprehensive guidelines and dynamic lab sections."""
@@ -823,7 +1407,13 @@ Return ONLY valid JSON, no markdown."""
             "path": file_path
         }]
         
-        extracted_text = await self.extract_text_from_files(files)
+        # an image is base64-encoded while its text is being extracted
+        if file_type == 'image':
+            extracted_text, base64_img = await asyncio.gather(
+                self.extract_text_from_files(files), self.encode_image_to_base64(file_path)
+            )
+        else:
+            extracted_text = await self.extract_text_from_files(files)
         
         # Comprehensive extraction
         extraction_messages = [
@@ -860,92 +1450,403 @@ Return detailed JSON with identified lab categories."""
         ]
         
         if file_type == 'image':
-            base64_img = await self.encode_image_to_base64(file_path)
             mime = mimetypes.guess_type(str(file_path))[0] or 'image/jpeg'
             extraction_messages[-1]["content"].append({
                 "type": "image_url",
                 "image_url": {"url": f"data:{mime};base64,{base64_img}"}
             })
 
-        resp1 = await self.openai_client.chat.completions.create(
-            model="gpt-4o",
+        resp1 = await self._chat_completion(
+            model=self.EXTRACTION_MODEL,
             messages=extraction_messages,
             temperature=0.2,
-            max_tokens=3000
+            max_tokens=FILE_EXTRACTION_MAX_TOKENS
         )
         extracted_data = resp1.choices[0].message.content
         
         # Generate structured report
         report_prompt = f"""Based on this single document, generate a focused medical analysis with dynamic lab sections.
 
-{self.get_medical_guidelines_prompt()}
+Return ONLY valid JSON.
 
 EXTRACTED DATA:
-{extracted_data}
+{extracted_data}"""
 
-Generate JSON with:
-1. **document_info**: Type, date, source
-2. **patient_info**: If available from document
-3. **laboratory_results**: DYNAMIC - create subsections for each actual lab category found
-4. **vital_signs**: If present
-5. **clinical_findings**: Any examination findings
-6. **calculations**: Perform BMI, etc. if height/weight present
-7. **interpretations**: Clinical significance of findings
-8. **recommendations**: Based on results
-9. **integrated_summary**: Key findings and next steps
+        report_messages = [
+            {"role": "system", "content": _FILE_REPORT_SYSTEM_PROMPT},
+            {"role": "user", "content": report_prompt}
+        ]
 
-IMPORTANT: 
-- Create lab subsections dynamically based on actual categories in document
-- Use exact formulas for any calculations possible
-- Flag abnormal/critical values
-- Provide clinical interpretations
+        resp2 = await self._chat_completion(
+            model=self.REPORT_MODEL,
+            messages=report_messages,
+            temperature=0.2,
+            max_tokens=FILE_REPORT_MAX_TOKENS,
+            response_format={"type": "json_object"}
+        )
+        
+        return orjson.loads(resp2.choices[0].message.content)
 
-Return ONLY valid JSON."""
+    async def analyze_files_batch(self, requests: List[Tuple[Path, str]]) -> List[Any]:
+        """Analyze several independent files with one extraction and one report call.
 
-        report_messages = [
+        Each document is labelled by number in the prompt and the model echoes that
+        number in its analysis, which is how results are matched back to files.
+        Falls back to per-file analysis if the batched call fails or any document's
+        analysis is missing; a file whose own analysis fails gets its exception in
+        place of a result, so it does not fail the other callers.
+        """
+        if len(requests) == 1:
+            return [await self.analyze_file_only(*requests[0])]
+        if len(requests) > FILE_BATCH_MAX:
+            groups = [requests[i:i + FILE_BATCH_MAX] for i in range(0, len(requests), FILE_BATCH_MAX)]
+            results = await asyncio.gather(*(self.analyze_files_batch(group) for group in groups))
+            return [analysis for group in results for analysis in group]
+
+        try:
+            analyses = await self._analyze_files_together(requests)
+        except ServiceBusyError:
+            raise
+        except Exception as e:
+            print(f"Batched file analysis failed: {e}")
+            analyses = None
+
+        if analyses is None:
+            print("Batched analysis could not be split per file, analyzing individually")
+            return list(await asyncio.gather(
+                *(self.analyze_file_only(p, t) for p, t in requests), return_exceptions=True
+            ))
+        return analyses
+
+    async def _analyze_files_together(self, requests: List[Tuple[Path, str]]) -> Optional[List[Dict[str, Any]]]:
+        """Run the batched extraction and report calls; None if the result cannot be split per file."""
+        files = [{
+            "url": str(file_path),
+            "field": file_path.name,
+            "type": file_type,
+            "path": file_path
+        } for file_path, file_type in requests]
+
+        # extract every document's text and base64-encode the images all at once
+        image_indexes = [i for i, f in enumerate(files) if f['type'] == 'image']
+        texts, encoded = await asyncio.gather(
+            asyncio.gather(*(self.extract_text_from_files([f]) for f in files)),
+            asyncio.gather(*(self.encode_image_to_base64(files[i]['path']) for i in image_indexes)),
+        )
+        base64_images = dict(zip(image_indexes, encoded))
+
+        user_content: List[Dict[str, Any]] = [{
+            "type": "text",
+            "text": f"""Extract comprehensive medical data from each of these {len(files)} independent documents.
+They belong to DIFFERENT patients - never mix information between documents.
+
+For every document include:
+- Patient demographics if present
+- ALL lab test categories identified (exact names)
+- All lab values with units and ranges
+- Vital signs and measurements
+- Clinical findings
+- Any diagnoses or recommendations
+
+Return detailed JSON with identified lab categories, one entry per DOCUMENT number."""
+        }]
+        for i, (f, text) in enumerate(zip(files, texts)):
+            user_content.append({
+                "type": "text",
+                "text": f"### DOCUMENT {i + 1}\nEXTRACTED TEXT (OCR/PDF):\n{text}"
+            })
+            if f['type'] == 'image':
+                base64_img = base64_images[i]
+                mime = mimetypes.guess_type(str(f['path']))[0] or 'image/jpeg'
+                user_content.append({
+                    "type": "image_url",
+                    "image_url": {"url": f"data:{mime};base64,{base64_img}"}
+                })
+
+        extraction_messages = [
             {
-                "role": "system", 
-                "content": "You are an expert medical document analyzer. Create focused, dynamically-structured analyses based on document content with accurate calculations."
+                "role": "system",
+                "content": f"""You are an expert medical data extraction assistant with OCR capabilities.
+
+{self.get_medical_guidelines_prompt()}
+
+Extract ALL medical information from each numbered document separately, identifying actual lab test categories present."""
             },
+            {"role": "user", "content": user_content}
+        ]
+
+        resp1 = await self._chat_completion(
+            model=self.EXTRACTION_MODEL,
+            messages=extraction_messages,
+            temperature=0.2,
+            max_tokens=FILE_EXTRACTION_MAX_TOKENS * len(files)
+        )
+        extracted_data = resp1.choices[0].message.content
+
+        report_prompt = f"""Based on these {len(files)} independent documents, generate one focused medical analysis per document with dynamic lab sections.
+Documents belong to different patients - never mix findings between analyses.
+
+Return JSON of the form {{"analyses": [ ... ]}} with EXACTLY {len(files)} objects, one per DOCUMENT.
+Each object MUST include a top-level "document" field holding its DOCUMENT number (1 to {len(files)}).
+Return ONLY valid JSON.
+
+EXTRACTED DATA (by DOCUMENT number):
+{extracted_data}"""
+
+        report_messages = [
+            {"role": "system", "content": _FILE_REPORT_SYSTEM_PROMPT},
             {"role": "user", "content": report_prompt}
         ]
 
-        resp2 = await self.openai_client.chat.completions.create(
-            model="gpt-4o",
+        resp2 = await self._chat_completion(
+            model=self.REPORT_MODEL,
             messages=report_messages,
             temperature=0.2,
-            max_tokens=4096,
+            max_tokens=FILE_REPORT_MAX_TOKENS * len(files),
             response_format={"type": "json_object"}
         )
-        
-        return json.loads(resp2.choices[0].message.content)
 
-    async def generate_report(self, user_id: str) -> Dict[str, Any]:
+        try:
+            analyses = orjson.loads(resp2.choices[0].message.content).get("analyses")
+        except Exception as e:
+            print(f"Error parsing batched analysis: {e}")
+            return None
+        if not isinstance(analyses, list):
+            return None
+
+        # documents belong to different users: match on the echoed number, never on position
+        by_document: Dict[int, Dict[str, Any]] = {}
+        for analysis in analyses:
+            if type(analysis) is not dict:
+                return None
+            number = analysis.pop("document", None)
+            if type(number) is str and number.strip().isdigit():
+                number = int(number)
+            if type(number) is not int or not 1 <= number <= len(files) or number in by_document:
+                return None
+            by_document[number] = analysis
+        if len(by_document) != len(files):
+            return None
+        return [by_document[i + 1] for i in range(len(files))]
+
+    async def generate_report(self, user_id: str, batch: bool = False) -> Dict[str, Any]:
         """Generate comprehensive report with mandatory core sections and dynamic lab sections.
 
         This method generates the report and saves it to the remote API in the background.
         Then converts to PDF and uploads to database.
+
+        With batch=True the OpenAI call goes through the Batch API instead (half the
+        price, but completion can take up to 24 hours); see generate_report_batch.
         """
+        if batch:
+            report = (await self.generate_report_batch([user_id]))[user_id]
+            if report is None:
+                raise RuntimeError(f"Batch report generation failed for {user_id}")
+            return report
+
         patient = await self.fetch_patient_data(user_id)
-        urls = self.extract_cloudinary_urls(patient)
-        files: List[Dict[str, Any]] = []
 
-        for i, u in enumerate(urls):
-            filename = f"{u['field'].replace('.', '_')}_{i}.{u.get('type','bin')}"
+        # identical patient data yields the same report, so serve it from cache
+        cache_key = self._report_cache_key(user_id, patient)
+        cached = self.report_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        async with self._analysis_dir() as work_dir:
+            files = await self._download_patient_files(patient, work_dir)
+            analysis = await self.analyze_with_openai(patient, files)
+        return self._finalize_report(user_id, analysis, cache_key)
+
+    async def generate_report_batch(
+        self, user_ids: List[str], poll_interval: float = 60.0
+    ) -> Dict[str, Optional[Dict[str, Any]]]:
+        """Generate reports for many patients through the OpenAI Batch API.
+
+        Batch requests cost half as much and use a separate rate-limit pool, but
+        OpenAI may take up to 24 hours to complete them, so this is meant for bulk
+        jobs (e.g. nightly runs) rather than interactive requests. Reports are
+        cached, saved and uploaded like those from generate_report.
+
+        Returns the report per user id, or None for patients whose report failed.
+        """
+        reports: Dict[str, Optional[Dict[str, Any]]] = dict.fromkeys(user_ids)
+        pending: Dict[str, Tuple[str, List[Dict[str, Any]]]] = {}
+
+        async def prepare(user_id: str) -> None:
             try:
-                path = await self.download_file(u['url'], filename)
-                files.append({**u, "path": path})
+                patient = await self.fetch_patient_data(user_id)
+                cache_key = self._report_cache_key(user_id, patient)
+                cached = self.report_cache.get(cache_key)
+                if cached is not None:
+                    reports[user_id] = cached
+                    return
+                # downloads are only read while building the messages
+                async with self._analysis_dir() as work_dir:
+                    files = await self._download_patient_files(patient, work_dir)
+                    pending[user_id] = (cache_key, await self.build_report_messages(patient, files))
             except Exception as e:
-                print(f"Error downloading file {u.get('url')}: {e}")
-                files.append({**u, "path": None, "error": str(e)})
+                print(f"Error preparing batch report for {user_id}: {e}")
+
+        await asyncio.gather(*(prepare(user_id) for user_id in reports))
+        if not pending:
+            return reports
+
+        batch_input = b"".join(
+            orjson.dumps({
+                "custom_id": user_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.REPORT_MODEL,
+                    "messages": messages,
+                    "temperature": 0.2,
+                    "max_tokens": 8000,
+                    "response_format": {"type": "json_object"}
+                }
+            }) + b"\n"
+            for user_id, (_, messages) in pending.items()
+        )
+        input_file = await self._batch_api_call(
+            self.openai_client.files.create,
+            file=("batchinput.jsonl", batch_input), purpose="batch"
+        )
+        batch = await self._batch_api_call(
+            self.openai_client.batches.create,
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
 
-        analysis = await self.analyze_with_openai(patient, files)
+        # the batch is already submitted (and billed): a failed poll must not
+        # abandon it, so transient errors just wait for the next poll
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(poll_interval)
+            try:
+                batch = await self._batch_api_call(self.openai_client.batches.retrieve, batch.id)
+            except _TRANSIENT_OPENAI_ERRORS as e:
+                print(f"Error polling report batch {batch.id}, retrying: {e}")
+
+        if not batch.output_file_id:
+            print(f"Report batch {batch.id} ended with status {batch.status}")
+            return reports
+
+        output = await self._batch_api_call(self.openai_client.files.content, batch.output_file_id)
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            result = orjson.loads(line)
+            user_id = result.get("custom_id")
+            if user_id not in pending:
+                continue
+            try:
+                response = result.get("response") or {}
+                if result.get("error") or response.get("status_code") != 200:
+                    raise RuntimeError(result.get("error") or response.get("body"))
+                analysis = orjson.loads(response["body"]["choices"][0]["message"]["content"])
+                reports[user_id] = self._finalize_report(user_id, analysis, pending[user_id][0])
+            except Exception as e:
+                print(f"Error in batch report for {user_id}: {e}")
+
+        return reports
+
+    async def generate_report_stream(self, user_id: str) -> AsyncIterator[bytes]:
+        """Generate the report like generate_report, yielding NDJSON events as it progresses.
 
+        Events, one JSON object per line:
+        - {"event": "status", "stage": "..."} as each pipeline stage starts
+        - {"event": "delta", "content": "..."} for each chunk of report JSON from the model
+        - {"event": "report", "report": {...}} with the complete report (same shape as generate_report)
+        - {"event": "error", "detail": "..."} if generation fails part-way
+        """
+        try:
+            yield self._ndjson({"event": "status", "stage": "fetching_patient_data"})
+            patient = await self.fetch_patient_data(user_id)
+
+            cache_key = self._report_cache_key(user_id, patient)
+            cached = self.report_cache.get(cache_key)
+            if cached is not None:
+                yield self._ndjson({"event": "report", "report": cached})
+                return
+
+            # the downloads are only read during extraction
+            async with self._analysis_dir() as work_dir:
+                yield self._ndjson({"event": "status", "stage": "downloading_files"})
+                files = await self._download_patient_files(patient, work_dir)
+
+                yield self._ndjson({"event": "status", "stage": "extracting"})
+                report_messages = await self.build_report_messages(patient, files)
+
+            yield self._ndjson({"event": "status", "stage": "generating_report"})
+            stream = await self._chat_completion(
+                model=self.REPORT_MODEL,
+                messages=report_messages,
+                temperature=0.2,
+                max_tokens=8000,
+                response_format={"type": "json_object"},
+                stream=True
+            )
+            parts: List[str] = []
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    yield self._ndjson({"event": "delta", "content": delta})
+
+            analysis = orjson.loads("".join(parts))
+            report = self._finalize_report(user_id, analysis, cache_key)
+            yield self._ndjson({"event": "report", "report": report})
+        except Exception as e:
+            print(f"Error streaming report for {user_id}: {e}")
+            yield self._ndjson({"event": "error", "detail": str(e)})
+
+    def _ndjson(self, event: Dict[str, Any]) -> bytes:
+        return orjson.dumps(event) + b"\n"
+
+    @asynccontextmanager
+    async def _analysis_dir(self) -> AsyncIterator[Path]:
+        """A fresh download directory for one analysis, removed with its files on exit."""
+        path = Path(await asyncio.to_thread(tempfile.mkdtemp, dir=self.temp_dir))
+        try:
+            yield path
+        finally:
+            await asyncio.to_thread(shutil.rmtree, path, ignore_errors=True)
+
+    async def _download_patient_files(self, patient: Dict[str, Any], dest_dir: Path) -> List[Dict[str, Any]]:
+        """Download the Cloudinary files referenced by the patient record that are read locally.
+
+        PDFs are always needed for text extraction. Images are passed to the model
+        by URL, so they are only downloaded when they can be OCR'd here, and files
+        of unknown type are never read. Skipped entries keep a None path.
+        """
+        urls = self.extract_cloudinary_urls(patient)
+        local = [i for i, u in enumerate(urls) if u['type'] == 'pdf' or (u['type'] == 'image' and OCR_AVAILABLE)]
+        # files are named by URL hash: field paths can contain any characters
+        items = [
+            {"url": urls[i]['url'], "filename": f"{content_hash(urls[i]['url'].encode()).hexdigest()[:32]}.{urls[i]['type']}"}
+            for i in local
+        ]
+        results: List[Any] = [None] * len(urls)
+        for i, result in zip(local, await self.download_files(items, dest_dir=dest_dir)):
+            results[i] = result
+
+        files: List[Dict[str, Any]] = []
+        for u, result in zip(urls, results):
+            if isinstance(result, Exception):
+                print(f"Error downloading file {u.get('url')}: {result}")
+                files.append({**u, "path": None, "error": str(result)})
+            else:
+                files.append({**u, "path": result})
+
+        return files
+
+    def _finalize_report(self, user_id: str, analysis: Dict[str, Any], cache_key: str) -> Dict[str, Any]:
+        """Wrap the analysis into a report, cache it and persist it in the background."""
         report: Dict[str, Any] = {
             "patient_id": user_id,
             "medical_analysis": analysis,
             "generation_timestamp": datetime.now().isoformat(),
         }
+        self.report_cache.set(cache_key, report)
 
         # save the report to remote API in background (fire and forget)
         asyncio.create_task(self.save_report(report))
@@ -955,6 +1856,11 @@ Return ONLY valid JSON."""
 
         return report
 
+    def _report_cache_key(self, user_id: str, patient: Dict[str, Any]) -> str:
+        """Key a report by user id plus a hash of the fetched patient record."""
+        payload = orjson.dumps(patient, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS, default=str)
+        return content_hash(user_id.encode("utf-8") + b":" + payload).hexdigest()
+
     async def save_report(self, report: Dict[str, Any]) -> Dict[str, Any]:
         """Save the generated report JSON to remote API and return the API response.
 
@@ -962,44 +1868,50 @@ Return ONLY valid JSON."""
         """
         url = f"{self.base_url}/patient-registration/save-report"
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=report, timeout=aiohttp.ClientTimeout(total=30)) as resp:
-                    # try to parse json response
-                    try:
-                        data = await resp.json()
-                    except Exception:
-                        text = await resp.text()
-                        data = {"status": resp.status, "text": text}
-                    # print confirmation when saved successfully (HTTP 2xx)
-                    if isinstance(resp.status, int) and 200 <= resp.status < 300:
-                        print("saved the report to DB")
-                    return {"status": resp.status, "response": data}
+            session = await self._get_session()
+            async with session.post(url, json=report, timeout=aiohttp.ClientTimeout(total=30)) as resp:
+                # try to parse json response
+                try:
+                    data = await resp.json(loads=orjson.loads)
+                except Exception:
+                    text = await resp.text()
+                    data = {"status": resp.status, "text": text}
+                # print confirmation when saved successfully (HTTP 2xx)
+                if isinstance(resp.status, int) and 200 <= resp.status < 300:
+                    print("saved the report to DB")
+                return {"status": resp.status, "response": data}
         except Exception as e:
             return {"status": "error", "error": str(e)}
 
     def _wrap_text(self, text):
         """Convert plain text or dict/list into safe wrapped string for PDF."""
         if isinstance(text, (dict, list)):
-            text = json.dumps(text, indent=2, ensure_ascii=False)
-        return Paragraph(str(text), getSampleStyleSheet()['BodyText'])
+            text = orjson.dumps(text, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS, default=str).decode()
+        return Paragraph(str(text), _PDF_BODY)
+
+    def _table_cell(self, value):
+        """Numbers and short markup-free strings go into tables as plain strings,
+        skipping Paragraph's XML parsing and layout; everything else is wrapped."""
+        if isinstance(value, (int, float, str)):
+            text = str(value)
+            if ('<' not in text and '&' not in text and '\n' not in text
+                    and stringWidth(text, "Helvetica", 10) <= PDF_PLAIN_CELL_WIDTH):
+                return text
+        return self._wrap_text(value)
 
     def _section_to_table(self, section_dict):
         """Convert sub-JSON (dict) into a PDF table with wrapping."""
         table_data = [["Key", "Value"]]
 
         for k, v in section_dict.items():
-            table_data.append([self._wrap_text(k), self._wrap_text(v)])
+            table_data.append([self._table_cell(k), self._table_cell(v)])
 
         table = Table(
             table_data,
             colWidths=[60*mm, 100*mm]
         )
 
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.lightgrey),
-            ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
-            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        ]))
+        table.setStyle(_PDF_TABLE_STYLE)
         
         return table
 
@@ -1016,7 +1928,7 @@ Return ONLY valid JSON."""
             bottomMargin=18*mm
         )
         
-        styles = getSampleStyleSheet()
+        styles = _PDF_STYLES
         story = []
 
         # ---- PATIENT ID ----
@@ -1075,17 +1987,23 @@ Return ONLY valid JSON."""
             data.add_field('patientId', user_id)
             data.add_field('reports', io.BytesIO(pdf_bytes), filename=f"report_{user_id}.pdf", content_type='application/pdf')
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, data=data, timeout=aiohttp.ClientTimeout(total=60)) as resp:
-                    try:
-                        response_data = await resp.json()
-                    except Exception:
-                        response_data = {"status": resp.status, "text": await resp.text()}
-                    
-                    if isinstance(resp.status, int) and 200 <= resp.status < 300:
-                        print("report uploaded to db")
-                    
-                    return {"status": resp.status, "response": response_data}
+            session = await self._get_session()
+            async with session.post(url, data=data, timeout=aiohttp.ClientTimeout(total=60)) as resp:
+                try:
+                    response_data = await resp.json(loads=orjson.loads)
+                except Exception:
+                    response_data = {"status": resp.status, "text": await resp.text()}
+                
+                if isinstance(resp.status, int) and 200 <= resp.status < 300:
+                    print("report uploaded to db")
+                
+                return {"status": resp.status, "response": response_data}
         except Exception as e:
             print(f"Error uploading report: {e}")
-            return {"status": "error", "error": str(e)}
\ No newline at end of file
+            return {"status": "error", "error": str(e)}
+
+
+@lru_cache(maxsize=1)
+def get_medical_report_service() -> MedicalReportService:
+    """Return the shared service instance so clients are built once per process."""
+    return MedicalReportService()
@@ -1,43 +1,210 @@
-import json
+import sys
+import orjson
 from reportlab.lib.pagesizes import A4
 from reportlab.lib import colors
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.lib.units import mm
+from reportlab.lib.utils import simpleSplit
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.pdfgen import canvas
+
+# Built once: a stylesheet is ~50 ParagraphStyles and every table shares one style
+_STYLES = getSampleStyleSheet()
+_BODY = _STYLES['BodyText']
+_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.lightgrey),
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
+    ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+])
 
 def wrap(text):
     """Convert plain text or dict/list into safe wrapped string."""
     if isinstance(text, (dict, list)):
-        text = json.dumps(text, indent=2, ensure_ascii=False)
-    return Paragraph(str(text), getSampleStyleSheet()['BodyText'])
+        text = orjson.dumps(text, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
+    return Paragraph(str(text), _BODY)
+
+def table_cell(value):
+    """Numbers and short markup-free strings go into tables as plain strings,
+    skipping Paragraph's XML parsing and layout; everything else is wrapped."""
+    if isinstance(value, (int, float, str)):
+        text = str(value)
+        # must fit the narrower key column unwrapped (Table's plain cells: Helvetica 10)
+        if ('<' not in text and '&' not in text and '\n' not in text
+                and stringWidth(text, "Helvetica", BODY_SIZE) <= KEY_WIDTH - 2*CELL_PAD):
+            return text
+    return wrap(value)
 
 def section_to_table(section_dict):
     """Convert sub-JSON (dict) into a PDF table with wrapping."""
     table_data = [["Key", "Value"]]
 
     for k, v in section_dict.items():
-        table_data.append([wrap(k), wrap(v)])
+        table_data.append([table_cell(k), table_cell(v)])
 
     table = Table(
         table_data,
         colWidths=[60*mm, 100*mm]   # Enough space + wrapping support
     )
 
-    table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.lightgrey),
-        ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-    ]))
+    table.setStyle(_TABLE_STYLE)
     
     return table
 
-def json_to_pdf():
+# Fast path layout: fixed Helvetica metrics instead of Platypus layout passes
+PAGE_WIDTH, PAGE_HEIGHT = A4
+MARGIN = 18*mm
+BODY_SIZE = 10
+LEADING = 12
+CELL_PAD = 6
+KEY_WIDTH, VALUE_WIDTH = 60*mm, 100*mm
+TEXT_WIDTH = PAGE_WIDTH - 2*MARGIN
+
+def as_text(value):
+    """Plain text for a cell: dicts/lists as indented JSON, everything else via str()."""
+    if isinstance(value, (dict, list)):
+        return orjson.dumps(value, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
+    return str(value)
+
+def text_width(text):
+    return stringWidth(text, "Helvetica", BODY_SIZE)
+
+def split_long_word(word, width):
+    """Break a word wider than `width` points into pieces that fit."""
+    pieces, piece = [], ""
+    for char in word:
+        if piece and text_width(piece + char) > width:
+            pieces.append(piece)
+            piece = ""
+        piece += char
+    return pieces + [piece]
+
+def wrap_lines(text, width):
+    """Wrap text to `width` points of Helvetica, keeping each line's indentation."""
+    lines = []
+    for line in text.splitlines() or [""]:
+        stripped = line.lstrip()
+        indent = line[:len(line) - len(stripped)]
+        while indent and text_width(indent) > width / 2:
+            indent = indent[:-1]
+        available = width - text_width(indent)
+        wrapped = []
+        for part in simpleSplit(stripped, "Helvetica", BODY_SIZE, available):
+            # simpleSplit leaves words longer than the line whole
+            wrapped.extend(split_long_word(part, available) if text_width(part) > available else [part])
+        lines.extend(indent + part for part in wrapped or [""])
+    return lines
+
+class CanvasReport:
+    """Draw the report straight onto a canvas in one linear pass, tracking y for page breaks."""
+
+    def __init__(self, pdf_file):
+        self.canvas = canvas.Canvas(pdf_file, pagesize=A4)
+        self.y = PAGE_HEIGHT - MARGIN
+
+    def new_page(self):
+        self.canvas.showPage()
+        self.y = PAGE_HEIGHT - MARGIN
+
+    def ensure_space(self, height):
+        if self.y - height < MARGIN:
+            self.new_page()
+
+    def heading(self, text, size):
+        # never leave a heading alone at the bottom of a page
+        self.ensure_space(size + 3 * (LEADING + CELL_PAD))
+        self.y -= size
+        self.canvas.setFont("Helvetica-Bold", size)
+        self.canvas.drawString(MARGIN, self.y, text)
+        self.y -= 6
+
+    def paragraph(self, value):
+        for line in wrap_lines(as_text(value), TEXT_WIDTH):
+            self.ensure_space(LEADING)
+            self.y -= LEADING
+            self.canvas.setFont("Helvetica", BODY_SIZE)
+            self.canvas.drawString(MARGIN, self.y, line)
+        self.y -= 14
+
+    def table(self, section_dict):
+        rows = [("Key", "Value")] + [(as_text(k), as_text(v)) for k, v in section_dict.items()]
+        # keep the header row together with the first data row
+        self.ensure_space(2 * (LEADING + CELL_PAD))
+        for index, (key, value) in enumerate(rows):
+            key_lines = wrap_lines(key, KEY_WIDTH - 2*CELL_PAD)
+            value_lines = wrap_lines(value, VALUE_WIDTH - 2*CELL_PAD)
+            total = max(len(key_lines), len(value_lines))
+            start = 0
+            # rows taller than the rest of the page continue on the next one
+            while start < total:
+                self.ensure_space(LEADING + CELL_PAD)
+                count = min(total - start, int((self.y - MARGIN - CELL_PAD) // LEADING))
+                self.draw_row(key_lines[start:start + count], value_lines[start:start + count], count, header=index == 0)
+                start += count
+                if start < total:
+                    self.new_page()
+        self.y -= 14
+
+    def draw_row(self, key_lines, value_lines, count, header):
+        c = self.canvas
+        height = count * LEADING + CELL_PAD
+        bottom = self.y - height
+        if header:
+            c.setFillColor(colors.lightgrey)
+            c.rect(MARGIN, bottom, KEY_WIDTH + VALUE_WIDTH, height, stroke=0, fill=1)
+            c.setFillColor(colors.black)
+        c.setLineWidth(0.5)
+        c.rect(MARGIN, bottom, KEY_WIDTH, height)
+        c.rect(MARGIN + KEY_WIDTH, bottom, VALUE_WIDTH, height)
+        c.setFont("Helvetica", BODY_SIZE)
+        baseline = self.y - CELL_PAD / 2 - BODY_SIZE
+        for i in range(count):
+            if i < len(key_lines):
+                c.drawString(MARGIN + 3, baseline - i * LEADING, key_lines[i])
+            if i < len(value_lines):
+                c.drawString(MARGIN + KEY_WIDTH + 3, baseline - i * LEADING, value_lines[i])
+        self.y = bottom
+
+    def save(self):
+        self.canvas.save()
+
+def json_to_pdf_canvas(data, pdf_file):
+    """Fast path: render the report with direct canvas drawing."""
+    report = CanvasReport(pdf_file)
+
+    # ---- PATIENT ID ----
+    if "PATIENT_ID" in data:
+        report.heading("PATIENT ID", 12)
+        report.paragraph(data["PATIENT_ID"])
+
+    # ---- MEDICAL ANALYSIS ----
+    report.heading("MEDICAL ANALYSIS", 16)
+
+    for section_name, section_value in data.get("medical_analysis", {}).items():
+        if isinstance(section_value, dict):
+            report.heading(section_name.replace('_',' ').title(), 12)
+            report.table(section_value)
+        else:
+            report.heading(section_name, 12)
+            report.paragraph(section_value)
+
+    report.save()
+
+def json_to_pdf(rich=False):
     json_file = "data.json"   # must be in same folder
     pdf_file = "output.pdf"
 
-    with open(json_file, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    with open(json_file, "rb") as f:
+        data = orjson.loads(f.read())
 
+    if rich:
+        json_to_pdf_rich(data, pdf_file)
+    else:
+        json_to_pdf_canvas(data, pdf_file)
+    print("PDF created:", pdf_file)
+
+def json_to_pdf_rich(data, pdf_file):
+    """Platypus layout with wrapped Paragraph cells (slower, richer text handling)."""
     doc = SimpleDocTemplate(
         pdf_file,
         pagesize=A4,
@@ -47,7 +214,7 @@ def json_to_pdf():
         bottomMargin=18*mm
     )
     
-    styles = getSampleStyleSheet()
+    styles = _STYLES
     story = []
 
     # ---- PATIENT ID ----
@@ -81,8 +248,8 @@ def json_to_pdf():
             story.append(Spacer(1, 14))
 
     doc.build(story)
-    print("PDF created:", pdf_file)
 
 
 if __name__ == "__main__":
-    json_to_pdf()
+    # --rich: the Platypus layout instead of the canvas fast path
+    json_to_pdf(rich="--rich" in sys.argv[1:])
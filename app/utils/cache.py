@@ -0,0 +1,20 @@
+import threading
+from typing import Any, Hashable, Optional
+
+from cachetools import TTLCache
+
+
+class ResponseCache:
+    """Thread-safe in-process TTL cache for generated reports and analyses."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600):
+        self._cache: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            return self._cache.get(key)
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._cache[key] = value
@@ -0,0 +1,20 @@
+import hashlib
+from pathlib import Path
+from typing import Union
+
+try:
+    from blake3 import blake3 as content_hash
+except ImportError:
+    content_hash = hashlib.blake2b
+
+# Files are hashed in chunks of this size
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def file_digest(path: Union[str, Path]) -> str:
+    """Content hash of a file (blake3 when installed, else blake2b), read in chunks."""
+    digest = content_hash()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,65 @@
+"""PDF text extraction that can run in worker processes.
+
+Kept free of the service's heavy imports (OCR engines, torch, reportlab) so
+worker processes only load the PDF backends.
+"""
+import threading
+from typing import List
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+try:
+    import PyPDF2
+except ImportError:
+    PyPDF2 = None
+
+# Whether any PDF text backend is installed
+PDF_TEXT_AVAILABLE = pdfium is not None or PyPDF2 is not None
+
+# PDFium is not thread-safe, even across documents: every call in a process is
+# serialized (pool workers are single-threaded, so this only matters in threads)
+_PDFIUM_LOCK = threading.Lock()
+
+
+def pdf_page_count(pdf_path: str) -> int:
+    if pdfium is not None:
+        with _PDFIUM_LOCK:
+            pdf = pdfium.PdfDocument(pdf_path)
+            try:
+                return len(pdf)
+            finally:
+                pdf.close()
+    with open(pdf_path, "rb") as f:
+        return len(PyPDF2.PdfReader(f).pages)
+
+
+def _pdfium_page_text(pdf, index: int) -> str:
+    page = pdf[index]
+    try:
+        textpage = page.get_textpage()
+        try:
+            return textpage.get_text_range()
+        finally:
+            textpage.close()
+    finally:
+        page.close()
+
+
+def extract_pdf_page_range(pdf_path: str, start: int, stop: int) -> List[str]:
+    """Extract text of pages [start, stop).
+
+    Uses the native PDFium engine when pypdfium2 is installed, else PyPDF2.
+    """
+    if pdfium is not None:
+        with _PDFIUM_LOCK:
+            pdf = pdfium.PdfDocument(pdf_path)
+            try:
+                return [_pdfium_page_text(pdf, i) for i in range(start, stop)]
+            finally:
+                pdf.close()
+    with open(pdf_path, "rb") as f:
+        reader = PyPDF2.PdfReader(f)
+        return [reader.pages[i].extract_text() for i in range(start, stop)]